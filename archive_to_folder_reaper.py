@@ -19,18 +19,30 @@ example usage:
 """
 
 import os
+import io
 import sys
+import json
+import copy
+import stat
+import errno
+import fcntl
 import time
 import glob
 import gzip
-import dicom
 import shutil
+import fnmatch
 import zipfile
 import tarfile
 import logging
+import montage
 import argparse
+import multiprocessing
+import dirscan
 import subprocess
-from distutils.dir_util import copy_tree
+import transcode
+import dicomheader
+import collections
+from multiprocessing.pool import ThreadPool
 
 
 logging.basicConfig(
@@ -39,26 +51,43 @@ logging.basicConfig(
                 )
 log = logging.getLogger()
 
+SUBJECT_ID_KEYWORDS = ['PatientName', 'PatientID', 'StudyID']
+DIGEST_FILES = ['._*', 'DIGEST.txt', 'METADATA.json', 'metadata.json', 'digest.txt'] # removed from nested archives
+PHYSIO_THREADS = 4
+FICLONE = 0x40049409    # linux ioctl that reflinks a whole file (btrfs, xfs)
 
-def extract_subject_id(root_path, args):
+
+def extract_subject_id(root_path, dicom_dirs, args):
     '''
     If no subjectID is provided as input, we will attempt to extract the ID from a dicom.
     If there are no dicom files then we use the name of the session folder to create a subject ID.
     If there is a dicom file, we read it and use the field that was passed in - if no field was
     passed in then we use values from the following fields, in order: PatientID, PatientName,
     StudyID ('ex' + StudyID).
+
+    dicom_dirs are the session's dicom folders; only the header of the first file in the
+    first one is read, up to the tags needed.
     '''
     log.info('No subjectID provided - Attempting to extract subject ID from dicom...')
-    subject_id = None
-
-    (file_paths, dir_paths, _, _, _) = get_paths(root_path)
-    dicom_dirs = [d for d in dir_paths if d.endswith('dicom')]
+    dcm = None
 
     # Read the dicom file and return an id from (PatientID - PatientName - StudyDate+StudyTime)
-    if dicom_dirs:
-        dicom_files = [d for d in file_paths if d.startswith(dicom_dirs[0])]
-        dcm = dicom.read_file(dicom_files[0])
+    dicom_file = next((entry.path for d in dicom_dirs for entry in dirscan.scan(d, stat=False)), None)
+    if dicom_file:
+        dcm = dicomheader.read_header(dicom_file, SUBJECT_ID_KEYWORDS + [args.subject_id_field])
+
+    subject_id = subject_id_from_header(dcm, args, os.path.basename(root_path))
+    log.info('... subjectID set to %s' % subject_id)
+    return subject_id
+
 
+def subject_id_from_header(dcm, args, session_label):
+    '''
+    Return the subject ID for a session, from the header dcm of one of its dicoms (see
+    extract_subject_id), or, if dcm is None or has no usable ID, from the session label.
+    '''
+    subject_id = None
+    if dcm is not None:
         # Use the field that was passed in
         if args.subject_id_field and dcm.get(args.subject_id_field):
             subject_id = dcm.get(args.subject_id_field)
@@ -87,25 +116,33 @@ def extract_subject_id(root_path, args):
     # No dicoms - use the session folder name
     if not subject_id or subject_id.isspace(): # This is empty b/c there are no dicoms, or the id field set failed
         log.info('... subjectID could not be extraced from DICOM header - setting subjectID  from session label')
-        subject_id = 'sub_' + os.path.basename(root_path).replace(' ', '_').replace(':','')
+        subject_id = subject_id_from_label(session_label)
 
     # Sanitize subject_id
-    subject_id = subject_id.replace(os.sep, '_')
+    return subject_id.replace(os.sep, '_')
 
-    log.info('... subjectID set to %s' % subject_id)
-    return subject_id
+
+def subject_id_from_label(session_label):
+    return ('sub_' + session_label.replace(' ', '_').replace(':','')).replace(os.sep, '_')
 
 
 def screen_save_montage(dirs):
     screen_saves = [f for f in dirs if f.endswith('Screen_Save')]
     if screen_saves:
         log.info('... %s screen saves to process' % str(len(screen_saves)))
+        jobs = []
         for d in screen_saves:
             pngs = glob.glob(d + '/*.png')
-            montage_name = pngs[0][:-5] + 'montage.png'
-            pngs = [shellquote(p) for p in pngs]
-            # Build the montage (requires imagemagick)
-            os.system('montage -geometry +4+4 ' + " ".join(pngs) + ' ' + shellquote(montage_name))
+            if not pngs:
+                log.warning('... no screen saves in %s' % d)
+                continue
+            jobs.append((pngs, pngs[0][:-5] + 'montage.png'))
+        build_montages(jobs)
+
+        for pngs, montage_name in jobs:
+            d = os.path.dirname(montage_name)
+            if not os.path.isfile(montage_name):
+                continue # keep the screen saves, the error has been logged
             # Move the contents of this folder to the correct acquitision directory
             ss_num = os.path.basename(d).split('_')[0][-2:] # This is the acquisition number we need
             if ss_num[0] == '0': # Drop the leading zero if it's the first char
@@ -122,47 +159,34 @@ def screen_save_montage(dirs):
 
 
 def extract_dicoms(files):
+    '''Extract the dicom archives in files, each into a 'dicom' folder next to it, and return those folders.'''
+    dicom_dirs = []
     dicom_arcs = [f for f in files if f.endswith('_dicoms.tgz') or f.endswith('_dicom.tgz')]
     if dicom_arcs:
         log.info('... %s dicom archives to extract' % str(len(dicom_arcs)))
         for f in dicom_arcs:
             utd = untar(f, os.path.dirname(f))
-            del_files = ['._*', 'DIGEST.txt', 'METADATA.json', 'metadata.json', 'digest.txt']
-            for df in del_files:
+            for df in DIGEST_FILES:
                 [os.remove(d) for d in glob.glob(utd + '/' + df)]
             log.debug('renaming %s' % utd)
             # BUG:TODO: This can be an issue if there is more than one dicom archive per acquisition (see ex9407 on SNI-SDM)
             os.rename(utd, os.path.join(os.path.dirname(utd), 'dicom'))
+            dicom_dirs.append(os.path.join(os.path.dirname(utd), 'dicom'))
             os.remove(f)
             log.debug('Removing %s' % f)
         log.info('... done')
     else:
         log.info('... 0 dicom archives found')
+    return dicom_dirs
 
 
-def extract_pfiles(files):
-    import zipfile
+def extract_pfiles(files, args):
     pfile_arcs = [f for f in files if f.endswith('_pfile.tgz')]
     if pfile_arcs:
         log.info('... %s pfile archives to extract' % str(len(pfile_arcs)))
         for f in pfile_arcs:
-            utd = untar(f, os.path.dirname(f))
-            [_files, _dirs, _, _, _] = get_paths(utd)
-            # Remove the files that should not be in the archive
-            del_files = ['._*', 'DIGEST.txt', 'METADATA.json', 'metadata.json', 'digest.txt']
-            for df in del_files:
-                [os.remove(d) for d in glob.glob(utd + '/' + df)]
-            # Gzip the P-file prior to adding to the archive
-            for p in _files:
-                if p.endswith('.7') and not p.endswith('_refscan.7'):
-                    gzfile = create_gzip(p, os.path.join(utd, p + '.gz'))
-                    os.remove(p)
-
-            # Zip the utd directory
-            zipdir(utd, utd + '.7.zip', os.path.basename(utd))
-
-            # Clean up the directory and files
-            shutil.rmtree(utd)
+            with tarfile.open(f, 'r|gz') as nested:
+                zip_pfiles(nested, os.path.dirname(f), args)
             os.remove(f)
         log.info('... done')
     else:
@@ -174,29 +198,36 @@ def extract_and_zip_physio(files):
     if physio_arcs:
         log.info('... %s physio archives to extract' % str(len(physio_arcs)))
         for f in physio_arcs:
-            utd = untar(f, os.path.dirname(f))
-            create_archive(utd, utd)
-            os.rename(utd + '.zip', utd + '.gephysio.zip')
-            shutil.rmtree(utd)
+            with tarfile.open(f, 'r|gz') as nested:
+                zip_physio(nested, os.path.dirname(f))
             os.remove(f)
         log.info('... done')
     else:
         log.info('... 0 physio archives found')
 
 
-def extract_physio(files):
+def extract_physio(files, args):
     physio_arcs = [f for f in files if f.endswith('.csv.gz')]
-    if physio_arcs:
+    if physio_arcs and args.keep_physio_gz:
+        log.info('... %s physio regressor file(s) kept gzipped' % str(len(physio_arcs)))
+    elif physio_arcs:
         log.info('... %s physio regressor file(s) to extract' % str(len(physio_arcs)))
-        for f in physio_arcs:
-            with gzip.open(f, 'rb') as in_file:
-                s = in_file.read()
-                with open(f[:-3], 'w') as a:
-                    a.write(s)
-            os.remove(f)
+        # decompression is mostly I/O and zlib, which releases the GIL
+        pool = ThreadPool(min(PHYSIO_THREADS, len(physio_arcs)))
+        try:
+            pool.map(gunzip, physio_arcs)
+        finally:
+            pool.terminate()
     else:
         log.info('... 0 physio regressors found')
 
+
+def gunzip(gz_file):
+    '''Decompress gz_file next to itself in chunks, then remove it.'''
+    with gzip.open(gz_file, 'rb') as f_in, open(gz_file[:-3], 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, transcode.CHUNK_SIZE)
+    os.remove(gz_file)
+
 def prune_tree(files, args):
     if args.prune:
         log.debug('Pruning files that end with %s ' % args.prune)
@@ -209,71 +240,416 @@ def prune_tree(files, args):
 
 ###### UTILITIES ######
 
-def shellquote(s):
-   return "'" + s.replace("'", "'\\''") + "'"
-
-
-def get_paths(root_path):
-    file_paths = []
-    dir_paths = []
-    groups = []
-    projects = []
-    sessions = []
-    for (root, dirs, files) in os.walk(root_path):
-        for name in files:
-            file_paths.append(os.path.join(root, name))
-        for name in dirs:
-            dir_paths.append(os.path.join(root, name))
-    if len(dir_paths) > 3:
-        group_level = len(dir_paths[1].split(os.sep))
-        project_level = group_level + 1
-        session_level = project_level + 1
-        [groups.append(d) for d in dir_paths if len(d.split(os.sep)) == group_level]
-        [projects.append(d) for d in dir_paths if len(d.split(os.sep)) == project_level]
-        [sessions.append(d) for d in dir_paths if len(d.split(os.sep)) == session_level]
-    return (file_paths, dir_paths, groups, projects, sessions)
+def build_montages(jobs):
+    '''Build each (png_paths, montage_name) montage in jobs, in process, or with ImageMagick if Pillow is missing.'''
+    if montage.Image is not None:
+        montage.build_montages(jobs)
+        return
+    for pngs, montage_name in jobs:
+        try:
+            status = subprocess.call(['montage', '-geometry', '+4+4'] + pngs + [montage_name])
+        except OSError as e:
+            status = e
+        if status:
+            log.error('... could not build %s with ImageMagick montage (Pillow is not installed): %s' % (montage_name, status))
+
+
+def move_session(session, target_path, threads=4):
+    '''
+    Move the session folder into target_path, and return the strategy used and the bytes copied.
+
+    Within a filesystem the folder is renamed ('rename'). Otherwise its files are
+    copied by a pool of threads, as reflinks where the filesystem can share
+    them between the two paths ('reflink'), else byte by byte ('copy'), and
+    the session is removed once all of them are in place.
+    '''
+    dst = os.path.join(target_path, os.path.basename(session))
+    if os.path.lexists(dst):
+        raise shutil.Error('Destination path %s already exists' % dst)
+    if os.lstat(session).st_dev == os.stat(target_path).st_dev:
+        try:
+            os.rename(session, dst)
+            return ('rename', 0)
+        except OSError as e:
+            if e.errno != errno.EXDEV:  # e.g. bind mounts of one filesystem
+                raise
+
+    entries = list(dirscan.scan(session, dirs=True))
+    os.mkdir(dst)
+    files = []
+    for entry in entries:
+        target = os.path.join(dst, os.path.relpath(entry.path, session))
+        if entry.is_link:
+            os.symlink(os.readlink(entry.path), target)
+        elif entry.is_dir:
+            os.mkdir(target)
+        else:
+            files.append((entry.path, target))
+    pool = ThreadPool(max(1, min(threads, len(files))))
+    try:
+        reflinked = pool.map(lambda paths: clone_or_copy(*paths), files)
+    finally:
+        pool.terminate()
+    # like copytree, directory times are set last
+    for entry in reversed(entries):
+        if entry.is_dir and not entry.is_link:
+            shutil.copystat(entry.path, os.path.join(dst, os.path.relpath(entry.path, session)))
+    shutil.copystat(session, dst)
+    shutil.rmtree(session)
+    nbytes = sum(entry.size for entry in entries if not entry.is_dir and not entry.is_link)
+    return ('reflink' if files and all(reflinked) else 'copy', nbytes)
+
+
+def clone_or_copy(src, dst):
+    '''Copy file src to dst, as a reflink if the filesystem supports it; return True if it was reflinked.'''
+    with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+        try:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+            reflinked = True
+        except (IOError, OSError):
+            shutil.copyfileobj(f_in, f_out, transcode.CHUNK_SIZE)
+            reflinked = False
+    shutil.copystat(src, dst)
+    return reflinked
+
+
+def build_tree_index(root_path):
+    '''
+    Walk root_path once and index it by group, project and session.
+
+    Returns (db_root_path, groups): groups maps each group path to its projects,
+    each project path to its sessions, and each session path to the
+    (file_paths, dir_paths) found below it, all in walk order. The group level
+    is that of the second directory found, i.e. root_path/db_root/group.
+    '''
+    entries = [(entry.path, entry.is_dir, entry.path[len(root_path):].lstrip(os.sep))
+               for entry in dirscan.scan(root_path, dirs=True, stat=False)]
+    dirs = [path for path, is_dir, _ in entries if is_dir]
+    groups = collections.OrderedDict()
+    if len(dirs) <= 3:
+        return (dirs[0] if dirs else None, groups)
+
+    group_depth = dirs[1][len(root_path):].lstrip(os.sep).count(os.sep) + 1
+    children = {}   # group and project relative paths -> their projects or sessions
+    sessions = {}   # session relative paths -> (file_paths, dir_paths)
+    for path, is_dir, relpath in entries:
+        depth = relpath.count(os.sep) + 1
+        if depth > group_depth + 2:
+            session = sessions.get(os.sep.join(relpath.split(os.sep, group_depth + 2)[:group_depth + 2]))
+            if session is not None:
+                session[1 if is_dir else 0].append(path)
+        elif is_dir and depth == group_depth:
+            groups[path] = children[relpath] = collections.OrderedDict()
+        elif is_dir and depth > group_depth:
+            parent = children.get(relpath.rsplit(os.sep, 1)[0])
+            if parent is None:
+                continue
+            if depth == group_depth + 1:
+                parent[path] = children[relpath] = collections.OrderedDict()
+            else:
+                parent[path] = sessions[relpath] = ([], [])
+    return (dirs[0], groups)
 
 
 def untar(fname, path):
     tar = tarfile.open(fname)
     tar.extractall(path)
-    untar_dir = '.'
-    while untar_dir.startswith('.'):
-        for name in range(0, len(tar.getnames())):
-            untar_dir = os.path.dirname(tar.getnames()[name])
-    untar_dir = os.path.join(path, untar_dir)
+    names = tar.getnames()
+    untar_dir = os.path.join(path, os.path.dirname(names[-1]) if names else '')
     tar.close()
     return untar_dir
 
 
-def create_archive(content_dir, arcname):
-    zipfilepath = content_dir + '.zip'
-    with zipfile.ZipFile(zipfilepath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
-        zf.write(content_dir, arcname)
-        for fn in os.listdir(content_dir):
-            zf.write(os.path.join(content_dir, fn), os.path.join(os.path.basename(arcname), fn))
-    return zipfilepath
+def stream_untar(fname, path, args):
+    '''
+    Extract the NIMS/SDM tar file in one pass, converting nested archives on the way.
+
+    Nested dicom archives are unpacked straight into a 'dicom' folder and nested
+    physio and pfile archives are transcoded straight into zip files, so none
+    of them is ever written to disk as a .tgz or extracted twice. Everything else is
+    extracted as is, for the session steps in main.
+    '''
+    directories = []
+    with tarfile.open(fname, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(('_dicoms.tgz', '_dicom.tgz')):
+                with tarfile.open(fileobj=tar.extractfile(member), mode='r|gz') as nested:
+                    unpack_dicoms(nested, os.path.join(path, os.path.dirname(member.name), 'dicom'))
+            elif member.isfile() and member.name.endswith('_physio.tgz'):
+                with tarfile.open(fileobj=tar.extractfile(member), mode='r|gz') as nested:
+                    zip_physio(nested, os.path.join(path, os.path.dirname(member.name)))
+            elif member.isfile() and member.name.endswith('_pfile.tgz'):
+                with tarfile.open(fileobj=tar.extractfile(member), mode='r|gz') as nested:
+                    zip_pfiles(nested, os.path.join(path, os.path.dirname(member.name)), args)
+            elif member.isdir():
+                # like extractall, set directory permissions and times once their contents are in
+                directories.append(member)
+                member = copy.copy(member)
+                member.mode = 0700
+                tar.extract(member, path)
+            else:
+                tar.extract(member, path)
+        for member in sorted(directories, key=lambda m: m.name, reverse=True):
+            dirpath = os.path.join(path, member.name)
+            tar.utime(member, dirpath)
+            tar.chmod(member, dirpath)
+
+
+def nested_relpath(member):
+    '''Return the path of a nested archive member below the archive's top folder, or None for digest files.'''
+    parts = member.name.strip('/').split('/', 1)
+    relpath = parts[-1]
+    if '/' not in relpath and any(fnmatch.fnmatch(relpath, df) for df in DIGEST_FILES):
+        return None
+    return relpath
+
+
+def unpack_dicoms(nested, dicom_dir):
+    '''Unpack the files of a nested dicom archive into dicom_dir, without the archive's top folder and digest files.'''
+    if not os.path.isdir(dicom_dir):
+        os.makedirs(dicom_dir)
+    for member in nested:
+        relpath = nested_relpath(member)
+        if not relpath or member.isdir():
+            continue
+        if not member.isfile():
+            log.warning('... skipping %s in dicom archive: not a regular file' % member.name)
+            continue
+        target = os.path.join(dicom_dir, relpath)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        with open(target, 'wb') as f_out:
+            shutil.copyfileobj(nested.extractfile(member), f_out)
+        os.chmod(target, member.mode)
+        os.utime(target, (member.mtime, member.mtime))
+
+
+def zip_physio(nested, acq_dir):
+    '''Transcode the top level files of a nested physio archive into acq_dir/<top folder>.gephysio.zip.'''
+    zf = None
+    try:
+        for member in nested:
+            if zf is None:
+                arcbase = member.name.strip('/').split('/', 1)[0]
+                if not os.path.isdir(acq_dir):
+                    os.makedirs(acq_dir)
+                zf = zipfile.ZipFile(os.path.join(acq_dir, arcbase + '.gephysio.zip'), 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+                zinfo = zipfile.ZipInfo(arcbase + '/', time.localtime(member.mtime)[:6])
+                zinfo.external_attr = ((stat.S_IFDIR | 0755) << 16) | 0x10
+                zf.writestr(zinfo, '')
+            relpath = member.name.strip('/').split('/', 1)[-1]
+            if not member.isfile() or '/' in relpath:
+                continue   # only the files right below the top folder
+            chunks = transcode.read_chunks(nested.extractfile(member))
+            transcode.write_chunks(zf, transcode.member_zipinfo(member, arcbase + '/' + relpath), chunks, member.size)
+    finally:
+        if zf is not None:
+            zf.close()
+
+
+def zip_pfiles(nested, acq_dir, args):
+    '''
+    Transcode a nested pfile archive into acq_dir/<top folder>.7.zip, without its digest and metadata files.
+
+    Files are zipped flat, right below the top folder. P-files (.7, but not
+    _refscan.7) are gzipped on the way, at args.gzip_level by args.gzip_threads
+    threads, and stored in the zip as .7.gz.
+    '''
+    zf = None
+    try:
+        for member in nested:
+            if zf is None:
+                arcbase = member.name.strip('/').split('/', 1)[0]
+                if not os.path.isdir(acq_dir):
+                    os.makedirs(acq_dir)
+                zf = zipfile.ZipFile(os.path.join(acq_dir, arcbase + '.7.zip'), 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+            if not member.isfile() or not nested_relpath(member):
+                continue
+            arcname = arcbase + '/' + os.path.basename(member.name)
+            if member.name.endswith('.7') and not member.name.endswith('_refscan.7'):
+                chunks = transcode.read_chunks(nested.extractfile(member), transcode.GZIP_BLOCK_SIZE)
+                chunks = transcode.parallel_gzip_chunks(chunks, args.gzip_level, args.gzip_threads)
+                # gzip data does not deflate any further
+                zinfo = transcode.member_zipinfo(member, arcname + '.gz', zipfile.ZIP_STORED)
+                transcode.write_chunks(zf, zinfo, chunks, member.size)
+            else:
+                chunks = transcode.read_chunks(nested.extractfile(member))
+                transcode.write_chunks(zf, transcode.member_zipinfo(member, arcname), chunks, member.size)
+    finally:
+        if zf is not None:
+            zf.close()
+
+
+def plan_conversion(args):
+    '''
+    Work out the final layout of args.tar_file and the bytes each step handles, without extracting anything.
+
+    The tar file and its nested archives are read as streams, once. The
+    subject ID of each session comes from the header of the first dicom in
+    its first dicom archive, as after extraction. Byte estimates: 'tar' is
+    the size of the extracted tar, 'dicoms', 'physio' and 'pfiles' the
+    unpacked size of the nested archives (the pfile zips come out smaller),
+    and 'final' the size of the tree after conversion, give or take the
+    compression of physio and pfile zips.
+    '''
+    totals = collections.OrderedDict((step, 0) for step in ['tar', 'dicoms', 'physio', 'pfiles', 'final'])
+    top_dirs = collections.OrderedDict()    # top level folders, in tar order
+    dirs = set()    # all folders, listed or implied by the paths of members
+    files = []      # (parts, size, step, unpacked size, header) of each file, in tar order
+    with tarfile.open(args.tar_file, 'r|*') as tar:
+        for member in tar:
+            parts = member_parts(member.name)
+            if not parts:
+                continue
+            top_dirs[parts[0]] = None
+            dirs.update(tuple(parts[:depth]) for depth in range(1, len(parts) + member.isdir()))
+            if not member.isfile():
+                continue
+            totals['tar'] += member.size
+            totals['final'] += member.size
+            step = nested_step(member.name)
+            unpacked = 0
+            header = None
+            if step:
+                with tarfile.open(fileobj=tar.extractfile(member), mode='r|gz') as nested:
+                    for nested_member in nested:
+                        if not nested_member.isfile():
+                            continue
+                        unpacked += nested_member.size
+                        if step == 'dicoms' and header is None and not args.subject and nested_relpath(nested_member):
+                            data = io.BytesIO(nested.extractfile(nested_member).read())
+                            try:
+                                header = dicomheader.read_header(data, SUBJECT_ID_KEYWORDS + [args.subject_id_field])
+                            except dicomheader.InvalidDicomError:
+                                log.warning('... %s in %s is not a dicom' % (nested_member.name, member.name))
+                totals[step] += unpacked
+                totals['final'] += unpacked - member.size
+            files.append((parts, member.size, step, unpacked, header))
+
+    # the levels are picked as build_tree_index picks them after extraction: the group level is
+    # that of the second folder in walk order, which is a top level folder if there are several
+    db_root = next(iter(top_dirs), None)
+    group_depth = 1 if len(top_dirs) > 1 else 2
+    sessions = collections.OrderedDict()    # tar path of session -> plan
+    for parts, size, step, unpacked, header in files:
+        if len(dirs) <= 3 or len(parts) <= group_depth + 2:
+            continue    # not inside a group/project/session folder
+        key = '/'.join(parts[:group_depth + 2])
+        if key not in sessions:
+            sessions[key] = session = collections.OrderedDict()
+            session['source'] = key
+            session['group'] = args.group or parts[group_depth - 1]
+            session['project'] = args.project or parts[group_depth]
+            session['subject'] = args.subject or None
+            session['subject_from'] = 'argument' if args.subject else None
+            session['target'] = None
+            session['bytes'] = collections.OrderedDict((step, 0) for step in ['tar', 'dicoms', 'physio', 'pfiles'])
+            session['header'] = None
+        session = sessions[key]
+        session['bytes']['tar'] += size
+        if step:
+            session['bytes'][step] += unpacked
+        if session['header'] is None:
+            session['header'] = header
+
+    targets = collections.Counter()
+    for session in sessions.itervalues():
+        dcm = session.pop('header')
+        if not session['subject']:
+            session_args = argparse.Namespace(group=session['group'], subject_id_field=args.subject_id_field)
+            session['subject'] = subject_id_from_header(dcm, session_args, os.path.basename(session['source']))
+            from_label = subject_id_from_label(os.path.basename(session['source']))
+            session['subject_from'] = 'session label' if session['subject'] == from_label else 'dicom'
+        session['target'] = '/'.join([session['group'], session['project'], session['subject'], os.path.basename(session['source'])])
+        targets[session['target']] += 1
+    for session in sessions.itervalues():
+        if targets[session['target']] > 1:
+            log.warning('... %d sessions would be moved to %s' % (targets[session['target']], session['target']))
+
+    plan = collections.OrderedDict()
+    plan['tar_file'] = args.tar_file
+    plan['db_root'] = db_root
+    plan['bytes'] = totals
+    if os.path.isdir(args.output_path):
+        st = os.statvfs(args.output_path)
+        plan['output_free_bytes'] = st.f_bavail * st.f_frsize
+    plan['duplicate_targets'] = sorted(target for target, count in targets.iteritems() if count > 1)
+    plan['sessions'] = sessions.values()
+    return plan
+
+
+def member_parts(name):
+    '''Return the path of tar member name as a list of folder and file names, without a leading './' or '/'.'''
+    parts = name.split('/')
+    while parts and parts[0] in ('', '.'):
+        parts.pop(0)
+    return [part for part in parts if part]
+
+
+def nested_step(name):
+    '''Return the step that converts the nested archive name, or None if it is not one.'''
+    if name.endswith(('_dicoms.tgz', '_dicom.tgz')):
+        return 'dicoms'
+    if name.endswith('_physio.tgz'):
+        return 'physio'
+    if name.endswith('_pfile.tgz'):
+        return 'pfiles'
+    return None
+
+
+def process_session(task):
+    '''
+    Pool worker: convert one session in place (steps 5-13 of main) and return its subject ID.
+
+    args is the worker's own copy, with group and project already set; the
+    subject is only derived here when args.subject is empty.
+    '''
+    session, file_paths, dir_paths, args = task
+    log.debug(session)
+    log.debug(args)
+
+    ## 5. Remove the 'qa.json' files (UI can't read them)
+    for f in file_paths:
+        if f.endswith('qa.json'):
+            os.remove(f)
+
+    ## 6. Rename: qa file to [...].qa.png and montage to .montage.zip
+    for f in file_paths:
+        if f.endswith('_qa.png'):
+            new_name = f.replace('_qa.png', '.qa.png')
+            os.rename(f, new_name)
+        if f.endswith('_montage.zip'):
+            new_name = f.replace('_montage.zip', '.montage.zip')
+            os.rename(f, new_name)
 
+    ## 7. Extract physio regressors (_physio_regressors.csv.gz)
+    log.info('Extracting physio regressors...')
+    extract_physio(file_paths, args)
 
-def zipdir(dirpath, zipname=None, arcbase=None):
-    if not arcbase:
-        arcbase = os.path.basename(dirpath)
-    if not zipname:
-        zipname = dirpath + '.zip'
-    zipf = zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
-    for root, dirs, files in os.walk(dirpath):
-        for _file in files:
-            zipf.write(os.path.join(root, _file), os.path.join(arcbase, _file))
-    zipf.close()
-    return zipname
+    ## 8. Move _physio.tgz files to gephsio and zip (removing digest .txt)
+    log.info('Extracting and repackaging physio data...')
+    extract_and_zip_physio(file_paths)
 
+    ## 9. Extract pfiles and remove the digest and metadata files and gzip the file
+    log.info('Extracting and repackaging pfiles...')
+    extract_pfiles(file_paths, args)
 
-def create_gzip(in_file, gz_file):
-    if not gz_file:
-        gz_file = in_file + '.gz'
-    with open(in_file, 'rb') as f_in, gzip.open(gz_file, 'wb') as f_out:
-        shutil.copyfileobj(f_in, f_out)
-    return gz_file
+    ## 10. Extract all the dicom archives and rename to 'dicom'
+    log.info('Extracting dicom archives...')
+    dicom_dirs = [d for d in dir_paths if d.endswith('dicom')] # unpacked by stream_untar
+    dicom_dirs += extract_dicoms(file_paths)
+
+    ## 11. Create a montage of the screen saves and move them to the correct acquisition
+    log.info('Processing screen saves...')
+    screen_save_montage(dir_paths)
+
+    ## 12. Get the subjectID (if not passed in)
+    subject = args.subject or extract_subject_id(session, dicom_dirs, args)
+
+    ## 13. Prune tree to remove unwanted files
+    prune_tree(file_paths, args)
+
+    return subject
 
 
 ######################################################################################
@@ -287,121 +663,96 @@ def main():
     arg_parser.add_argument('-i', '--subject_id_field', help='Look here for the subject id', type=str, default='')
     arg_parser.add_argument('-l', '--loglevel', default='info', help='log level [default=info]')
     arg_parser.add_argument('--prune', action='append', help='Files that end with this string will be pruned from final tree.')
+    arg_parser.add_argument('--keep-physio-gz', action='store_true', help='leave physio regressors (.csv.gz) gzipped, for consumers that read gzip directly')
+    arg_parser.add_argument('--plan', action='store_true', help='print the final layout and byte estimates as json, without extracting anything')
+    arg_parser.add_argument('--stream', action='store_true', help='unpack nested dicom and physio archives while reading the tar file, instead of extracting it first')
+    arg_parser.add_argument('--scratch', help='extract and convert the tar file in this directory, then move the sessions to output_path')
+    arg_parser.add_argument('--copy-threads', type=int, default=4, help='number of threads copying files when sessions move across filesystems [default=4]')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1, help='number of sessions converted in parallel [default=1]')
+    arg_parser.add_argument('--gzip-level', type=int, default=9, help='compression level of gzipped P-files [default=9]')
+    arg_parser.add_argument('--gzip-threads', type=int, default=multiprocessing.cpu_count(), help='number of threads gzipping each P-file [default=number of CPUs]')
 
     args = arg_parser.parse_args()
 
     log.setLevel(getattr(logging, args.loglevel.upper()))
     log.debug(args)
 
+    if args.plan:
+        json.dump(plan_conversion(args), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
     # Output directory will be named with the current date and time
     output_path = os.path.join(os.path.realpath(args.output_path), time.strftime('%Y-%m-%d_%H_%M_%S'))
 
 
+    # The tar file is extracted and converted in scratch_path, which is the output directory unless --scratch is given
+    if args.scratch:
+        scratch_path = os.path.join(os.path.realpath(args.scratch), os.path.basename(output_path))
+    else:
+        scratch_path = output_path
+
+
     ## 1. Make the output directory where the tar file will be extracted
     os.mkdir(output_path)
+    if scratch_path != output_path:
+        os.mkdir(scratch_path)
 
 
     ## 2. Extract the nims tar file
-    log.info('Extracting %s to %s' % (args.tar_file, output_path))
-    untar(args.tar_file, output_path)
+    log.info('Extracting %s to %s' % (args.tar_file, scratch_path))
+    if args.stream:
+        stream_untar(args.tar_file, scratch_path, args)
+    else:
+        untar(args.tar_file, scratch_path)
 
 
     ## 3. Generate file paths and directory paths
-    log.info('Extracting path and file info in %s' % output_path)
-    (file_paths, dir_paths, group_paths, project_paths, session_paths) = get_paths(output_path)
-    db_root_path = dir_paths[0] # sdm or nims path (removed later)
+    log.info('Extracting path and file info in %s' % scratch_path)
+    (db_root_path, groups) = build_tree_index(scratch_path) # db_root is the sdm or nims path (removed later)
 
 
-    ## 4. Handle missing arguments
-    if not args.group:
-        get_group = True
-    else:
-        get_group = False
-    if not args.project:
-        get_project = True
-    else:
-        get_project = False
-    if not args.subject:
-        get_subject_id = True
-    else:
-        get_subject_id = False
-
-    # Go through groups/projects/sessions
-    for group in group_paths:
-        if get_group == True:
-            args.group = os.path.basename(group)
+    ## 4. Handle missing arguments: each session gets its own copy of args, with the
+    ## group and project taken from the tree (if not passed in)
+    tasks = []
+    for group, projects in groups.iteritems():
         log.debug(group)
-        log.debug(args)
-        projects = []
-        [projects.append(p) for p in project_paths if p.startswith(group)]
-
-        for project in projects:
-            if get_project == True:
-                args.project = os.path.basename(project)
+        for project, sessions in projects.iteritems():
             log.debug(project)
-            log.debug(args)
-            sessions = []
-            [sessions.append(s) for s in session_paths if s.startswith(project)]
-
-            for session in sessions:
-                (file_paths, dir_paths, _, _, _) = get_paths(session)
-                log.debug(session)
-                log.debug(project)
-                log.debug(args)
-
-                ## 5. Remove the 'qa.json' files (UI can't read them)
-                for f in file_paths:
-                    if f.endswith('qa.json'):
-                        os.remove(f)
-
-                ## 6. Rename: qa file to [...].qa.png and montage to .montage.zip
-                for f in file_paths:
-                    if f.endswith('_qa.png'):
-                        new_name = f.replace('_qa.png', '.qa.png')
-                        os.rename(f, new_name)
-                    if f.endswith('_montage.zip'):
-                        new_name = f.replace('_montage.zip', '.montage.zip')
-                        os.rename(f, new_name)
-
-                ## 7. Extract physio regressors (_physio_regressors.csv.gz)
-                log.info('Extracting physio regressors...')
-                extract_physio(file_paths)
-
-                ## 8. Move _physio.tgz files to gephsio and zip (removing digest .txt)
-                log.info('Extracting and repackaging physio data...')
-                extract_and_zip_physio(file_paths)
-
-                ## 9. Extract pfiles and remove the digest and metadata files and gzip the file
-                log.info('Extracting and repackaging pfiles...')
-                extract_pfiles(file_paths)
-
-                ## 10. Extract all the dicom archives and rename to 'dicom'
-                log.info('Extracting dicom archives...')
-                extract_dicoms(file_paths)
-
-                ## 11. Create a montage of the screen saves and move them to the correct acquisition
-                log.info('Processing screen saves...')
-                screen_save_montage(dir_paths)
-
-                ## 12. Get the subjectID (if not passed in)
-                if get_subject_id == True:
-                    args.subject = extract_subject_id(session, args)
-
-                ## 13. Prune tree to remove unwanted files
-                prune_tree(file_paths, args)
-
-                ## 14. Make the folder hierarchy and move the session to it's right place
-                log.info('Organizing final file structure...')
-                target_path = os.path.join(output_path, args.group, args.project, args.subject)
-                log.debug('Target Path: %s' % target_path)
-                log.debug(session)
-                if not os.path.isdir(target_path):
-                    os.makedirs(target_path)
-                shutil.move(session, target_path) # Move the session to the target
+            for session, (file_paths, dir_paths) in sessions.iteritems():
+                session_args = argparse.Namespace(**vars(args))
+                session_args.group = args.group or os.path.basename(group)
+                session_args.project = args.project or os.path.basename(project)
+                tasks.append((session, file_paths, dir_paths, session_args))
+
+    # Steps 5-13 only touch files inside their session, so sessions can be converted in parallel
+    pool = None
+    if args.jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(tasks)))
+        subjects = pool.imap(process_session, tasks)
+    else:
+        subjects = (process_session(task) for task in tasks)
+
+    for (session, _, _, session_args), subject in zip(tasks, subjects):
+        ## 14. Make the folder hierarchy and move the session to it's right place; this is
+        ## done here, one session at a time, as sessions can share a target path
+        log.info('Organizing final file structure...')
+        target_path = os.path.join(output_path, session_args.group, session_args.project, subject)
+        log.debug('Target Path: %s' % target_path)
+        log.debug(session)
+        if not os.path.isdir(target_path):
+            os.makedirs(target_path)
+        strategy, nbytes = move_session(session, target_path, args.copy_threads) # Move the session to the target
+        log.info('... moved %s to %s by %s, %d bytes copied' % (session, target_path, strategy, nbytes))
+    if pool:
+        pool.close()
+        pool.join()
 
 
     ## 15. Remove the db root folder
     shutil.rmtree(db_root_path)
+    if scratch_path != output_path:
+        os.rmdir(scratch_path)
 
 
     log.info("Done.")
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Partial DICOM header reading.
+
+Parsing stops at the highest tag needed for the requested keywords, so large
+private blobs (e.g. Siemens CSA headers) and pixel data are never read. Files
+without the 128 byte preamble and 'DICM' magic are rejected before any parsing.
+
+example usage:
+    dcm = read_header('/path/to/file.dcm', ['StudyInstanceUID', 'SeriesNumber'])
+
+"""
+
+from dicom.datadict import tag_for_name
+from dicom.errors import InvalidDicomError
+from dicom.filereader import read_partial
+
+PREAMBLE_LENGTH = 128
+MAGIC = 'DICM'
+READ_BUFFER = 16 * 1024         # header elements of interest usually sit in the first few KB
+DEFER_SIZE = 1024               # seek past larger values instead of reading them
+PIXEL_DATA = 0x7fe00010
+
+
+def is_dicom(fileobj):
+    """Check for the preamble and 'DICM' magic; fileobj is left positioned after the magic."""
+    return fileobj.read(PREAMBLE_LENGTH + len(MAGIC))[PREAMBLE_LENGTH:] == MAGIC
+
+
+def stop_tag(keywords):
+    """Return the tag after which parsing can stop, or the pixel data tag if any keyword is unknown."""
+    tags = [tag_for_name(kw) for kw in keywords if kw]
+    if not tags or None in tags:
+        return PIXEL_DATA
+    return max(tags)
+
+
+def read_header(path_or_fileobj, keywords=None):
+    """
+    Read the DICOM header from path_or_fileobj up to and including the tags of keywords.
+
+    If no keywords are given, parsing stops before the pixel data, like
+    dicom.read_file(..., stop_before_pixels=True). Raises InvalidDicomError
+    for files without a DICOM preamble.
+    """
+    last_tag = stop_tag(keywords or [])
+    stop_when = lambda tag, VR, length: tag > last_tag or tag == PIXEL_DATA
+    if isinstance(path_or_fileobj, basestring):
+        with open(path_or_fileobj, 'rb', READ_BUFFER) as fileobj:
+            return _read_header(fileobj, stop_when, DEFER_SIZE)
+    # deferred values can only be re-read from a named file, so read everything up to the stop tag
+    return _read_header(path_or_fileobj, stop_when, None)
+
+
+def _read_header(fileobj, stop_when, defer_size):
+    if not is_dicom(fileobj):
+        raise InvalidDicomError('File is missing \'DICM\' marker')
+    fileobj.seek(0)
+    return read_partial(fileobj, stop_when=stop_when, defer_size=defer_size)
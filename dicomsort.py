@@ -25,21 +25,69 @@ get usage help
 
 import os
 import json
+import zlib
 import time
-import dicom
+import sqlite3
 import hashlib
 import tarfile
 import argparse
-
-
-def create_archive(path, content, arcname, **kwargs):
+import subprocess
+import collections
+import dirscan
+import progress
+import dicomheader
+import multiprocessing
+from distutils.spawn import find_executable
+
+ROUTING_KEYWORDS = ['StudyInstanceUID', 'StudyID', 'SeriesNumber', 'AcquisitionNumber', 'Manufacturer']
+DIGEST_INDEX = '.dicomsort_digests.db'
+SORT_JOURNAL = '.dicomsort_sort.journal'
+
+# compressor name: (archive extension, external command or None for the tarfile built-in gzip)
+COMPRESSORS = {
+    'gzip': ('.tgz', None),
+    'pigz': ('.tgz', ['pigz', '-c', '-{level}']),
+    'zstd': ('.tar.zst', ['zstd', '-c', '-q', '-T0', '-{level}']),
+}
+
+
+def create_archive(path, content, arcname, compressor='gzip', compresslevel=6):
     def add_to_archive(archive, content, arcname):
         archive.add(content, arcname, recursive=False)
         if os.path.isdir(content):
             for fn in sorted(os.listdir(content), key=lambda fn: not fn.endswith('.json')):
                 add_to_archive(archive, os.path.join(content, fn), os.path.join(arcname, fn))
-    with tarfile.open(path, 'w:gz', **kwargs) as archive:
-        add_to_archive(archive, content, arcname)
+    command = COMPRESSORS[compressor][1]
+    if not command:
+        with tarfile.open(path, 'w:gz', compresslevel=compresslevel) as archive:
+            add_to_archive(archive, content, arcname)
+        return
+    # stream an uncompressed tar through the external compressor
+    with open(path, 'wb') as archive_file:
+        proc = subprocess.Popen([arg.format(level=compresslevel) for arg in command], stdin=subprocess.PIPE, stdout=archive_file)
+        with tarfile.open(fileobj=proc.stdin, mode='w|') as archive:
+            add_to_archive(archive, content, arcname)
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise OSError('%s exited with status %d while writing %s' % (command[0], proc.returncode, path))
+
+
+def resolve_compressor(compressor):
+    """Return compressor, or 'gzip' if its command is not installed."""
+    command = COMPRESSORS[compressor][1]
+    if command and not find_executable(command[0]):
+        print 'warning: %s not found, falling back to gzip' % command[0]
+        return 'gzip'
+    return compressor
+
+
+def archive_series(task):
+    """Pool worker: archive one series directory via a .part file, so that an interrupted archive never looks up-to-date."""
+    dirpath, archive_path, compressor, compresslevel = task
+    create_archive(archive_path + '.part', dirpath, os.path.basename(dirpath), compressor, compresslevel)
+    os.rename(archive_path + '.part', archive_path)
+    nbytes = sum(os.path.getsize(os.path.join(dirpath, fn)) for fn in os.listdir(dirpath))
+    return dirpath, archive_path, nbytes
 
 
 def write_json_file(path, json_document):
@@ -47,6 +95,28 @@ def write_json_file(path, json_document):
         json.dump(json_document, json_file)
 
 
+def update_json_file(path, json_document):
+    """Write json_document to path, unless path already holds it; keeps mtimes stable for up_to_date()."""
+    try:
+        with open(path) as json_file:
+            if json.load(json_file) == json_document:
+                return
+    except (IOError, ValueError):
+        pass
+    write_json_file(path, json_document)
+
+
+def up_to_date(archive_path, content_dir):
+    """Check whether archive_path is newer than content_dir and every file in it."""
+    try:
+        archive_mtime = os.path.getmtime(archive_path)
+    except OSError:
+        return False
+    mtimes = [os.path.getmtime(content_dir)]
+    mtimes += [os.path.getmtime(os.path.join(content_dir, fn)) for fn in os.listdir(content_dir)]
+    return archive_mtime > max(mtimes)
+
+
 def checksum(path):
     hash_ = hashlib.sha1()
     with open(path, 'rb') as fd:
@@ -55,49 +125,327 @@ def checksum(path):
     return hash_.digest()
 
 
-def sort(args):
+class DigestIndex(object):
+
+    """
+    Persistent sha1 digests of files, keyed by (device, inode) and validated by size and mtime.
+
+    Changes are committed every commit_every changes and on close(), so an
+    interrupted run loses at most that many digests.
+    """
+
+    def __init__(self, path, commit_every=100):
+        self.db = sqlite3.connect(path)
+        self.commit_every = commit_every
+        self.changes = 0
+        self.db.execute('CREATE TABLE IF NOT EXISTS digests '
+                        '(dev INTEGER, ino INTEGER, size INTEGER, mtime REAL, digest BLOB, PRIMARY KEY (dev, ino))')
+
+    def digest(self, path, st=None):
+        st = st or os.stat(path)
+        row = self.db.execute('SELECT size, mtime, digest FROM digests WHERE dev=? AND ino=?', (st.st_dev, st.st_ino)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+            return str(row[2])
+        digest = checksum(path)
+        self.db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)',
+                        (st.st_dev, st.st_ino, st.st_size, st.st_mtime, sqlite3.Binary(digest)))
+        self._changed()
+        return digest
+
+    def identical(self, path1, path2):
+        st1, st2 = os.stat(path1), os.stat(path2)
+        if st1.st_size != st2.st_size:
+            return False
+        return self.digest(path1, st1) == self.digest(path2, st2)
+
+    def forget(self, path):
+        st = os.stat(path)
+        self.db.execute('DELETE FROM digests WHERE dev=? AND ino=?', (st.st_dev, st.st_ino))
+        self._changed()
+
+    def _changed(self):
+        self.changes += 1
+        if self.changes >= self.commit_every:
+            self.db.commit()
+            self.changes = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class Journal(object):
+
+    """
+    Append-only log of the files that sort left in place, one json object per line.
+
+    Non-DICOM files and non-identical duplicates are recorded as 'skip' entries,
+    which --resume runs do not parse again. Every run appends to the journal;
+    only --resume runs read it.
+    """
+
+    def __init__(self, path, resume=False):
+        self.done = set()
+        if resume and os.path.isfile(path):
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue        # torn last line of an interrupted run
+                    self.done.add((entry['op'], entry['key']))
+        self.journal_file = open(path, 'a')
+
+    def __contains__(self, op_key):
+        return op_key in self.done
+
+    def record(self, op, key, **kwargs):
+        kwargs.update(op=op, key=key)
+        self.journal_file.write(json.dumps(kwargs) + '\n')
+        self.journal_file.flush()
+        self.done.add((op, key))
+
+    def close(self):
+        self.journal_file.close()
+
+
+def file_key(path):
+    """Journal key of path: its absolute path, size and mtime, so runs from other directories match."""
+    st = os.stat(path)
+    return '%s:%d:%r' % (os.path.abspath(path), st.st_size, st.st_mtime)
+
+
+class SeriesArchive(object):
+
+    """
+    Gzip'd tar of one series directory, that files are appended to as they are sorted.
+
+    The archive is written to a .part file through one compressor that lives as
+    long as the archive, so the file can be closed between appends and the
+    result is still a single gzip member; streaming tar readers (mode 'r|gz')
+    stop at the end of the first member of concatenated ones. finish() writes
+    the end-of-archive blocks, flushes the compressor and renames the file.
+    """
+
+    def __init__(self, path, arcname, metadata, compresslevel=6):
+        self.path = path
+        self.arcname = arcname
+        self.digests = {}
+        self.compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.fileobj = open(path + '.part', 'wb')
+        self._add_member(tarfile.DIRTYPE, arcname, mode=0755)
+        metadata_json = json.dumps(metadata)
+        self._add_member(tarfile.REGTYPE, arcname + '/metadata.json', size=len(metadata_json), data=metadata_json)
+
+    def reopen(self):
+        if self.fileobj is None:
+            self.fileobj = open(self.path + '.part', 'ab')
+
+    def close(self):
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
+    def add(self, filepath):
+        """Append filepath; return False if a different file of the same name is in the archive already."""
+        name = os.path.basename(filepath)
+        if name in self.digests:
+            return self.digests[name] == checksum(filepath)
+        st = os.stat(filepath)
+        with open(filepath, 'rb') as fd:
+            self.digests[name] = self._add_member(tarfile.REGTYPE, self.arcname + '/' + name,
+                                                  size=st.st_size, mode=st.st_mode & 07777, mtime=st.st_mtime, data=fd)
+        return True
+
+    def finish(self):
+        self.reopen()
+        self._write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        self.fileobj.write(self.compressor.flush())
+        self.close()
+        os.rename(self.path + '.part', self.path)
+
+    def _write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def _add_member(self, type_, name, size=0, mode=0644, mtime=None, data=None):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.type = type_
+        tarinfo.size = size
+        tarinfo.mode = mode
+        tarinfo.mtime = mtime or time.time()
+        self._write(tarinfo.tobuf())
+        hash_ = hashlib.sha1()
+        if isinstance(data, basestring):
+            hash_.update(data)
+            self._write(data)
+        elif data is not None:
+            for chunk in iter(lambda: data.read(1048576), ''):
+                hash_.update(chunk)
+                self._write(chunk)
+        if size % tarfile.BLOCKSIZE:
+            self._write(tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+        return hash_.digest()
+
+
+class SeriesStreams(object):
+
+    """SeriesArchives by series directory, of which at most max_open are kept open; the least recently used are closed."""
+
+    def __init__(self, args, metadata):
+        self.args = args
+        self.metadata = metadata
+        self.archives = {}
+        self.lru = collections.OrderedDict()
+
+    def get(self, acq_path):
+        archive = self.archives.get(acq_path)
+        if archive is None:
+            archive_path = os.path.join(self.args.tar_path, os.path.relpath(acq_path, self.args.sort_path).replace('/', '_') + '.tgz')
+            archive = self.archives[acq_path] = SeriesArchive(archive_path, os.path.basename(acq_path), self.metadata, self.args.compresslevel)
+            if not self.args.skip_sort_dir:
+                # keep the sort directory as tar() would leave it, and start with what
+                # earlier runs put there already
+                if not os.path.isdir(acq_path):
+                    os.makedirs(acq_path)
+                update_json_file(os.path.join(acq_path, 'metadata.json'), self.metadata)
+                for fn in os.listdir(acq_path):
+                    if fn != 'metadata.json':
+                        archive.add(os.path.join(acq_path, fn))
+        archive.reopen()
+        self.lru.pop(acq_path, None)
+        self.lru[acq_path] = archive
+        while len(self.lru) > self.args.max_open:
+            self.lru.popitem(last=False)[1].close()
+        return archive
+
+    def finish(self):
+        for _, archive in sorted(self.archives.iteritems()):
+            archive.finish()
+        self.lru.clear()
+
+
+def info(args, message):
+    if not args.quiet:
+        print message
+
+
+def series_metadata(args):
+    metadata = {'filetype': 'dicom'}
+    if args.group:
+        if not args.project:
+            args.project='unknown'
+        overwrite = {'overwrite': { 'group_name': args.group, 'project_name': args.project }}
+        metadata.update(overwrite)
+    return metadata
+
+
+def read_routing(filepath):
+    """Parse the header of filepath and return (filepath, routing), routing being None for non-DICOM files."""
+    try:
+        dcm = dicomheader.read_header(filepath, ROUTING_KEYWORDS)
+        routing = (
+                str(dcm.StudyInstanceUID),
+                str(dcm.StudyID),
+                str(dcm.SeriesNumber),
+                int(dcm.get('AcquisitionNumber', 1)),
+                str(dcm.get('Manufacturer', '')),
+                )
+    except:
+        routing = None
+    return filepath, routing
+
+
+def acquisition_path(sort_path, routing):
+    study_uid, study_id, series_no, acq_no, manufacturer = routing
+    if manufacturer.upper() != 'SIEMENS':
+        acq_name = '%s_%s_%s_dicoms' % (study_id, series_no, acq_no)
+    else:
+        acq_name = '%s_%s_dicoms' % (study_id, series_no)
+    return os.path.join(sort_path, study_uid, acq_name)
+
+
+def sort(args, streams=None):
     if not os.path.isdir(args.sort_path):
         os.makedirs(args.sort_path)
     if not os.access(args.sort_path, os.W_OK):
         print 'error: sort_path is not a writable directory'
 
     files = []
-    print 'inspecting %s' % args.path
-    for dirpath, dirnames, filenames in os.walk(args.path):
-        for filepath in [dirpath + '/' + fn for fn in filenames if not fn.startswith('.')]:
-            if not os.path.islink(filepath):
-                files.append(filepath)
+    info(args, 'inspecting %s' % args.path)
+    args.progress.begin('walk')
+    for entry in dirscan.scan(args.path, stat=False, jobs=args.jobs):
+        if not entry.is_link and not os.path.basename(entry.path).startswith('.'):
+            files.append(entry.path)
+            args.progress.advance()
+    args.progress.end()
+    journal = Journal(os.path.join(args.sort_path, SORT_JOURNAL), args.resume)
+    if args.resume:
+        # moved files are gone from path already; this skips re-parsing the ones that were left behind
+        files = [filepath for filepath in files if ('skip', file_key(filepath)) not in journal]
     file_cnt = len(files)
     cnt_width = len(str(file_cnt))
 
-    print 'found %d files to sort (ignoring symlinks and dotfiles)' % file_cnt
-    time.sleep(2)
-
-    for i, filepath in enumerate(files):
-        if args.verbose:
-            print '%*d/%d' % (cnt_width, i+1, file_cnt),
-        try:
-            dcm = dicom.read_file(filepath, stop_before_pixels=True)
-        except:
-            print 'not a DICOM file: %s' % filepath
-        else:
-            if dcm.get('Manufacturer').upper() != 'SIEMENS':
-                acq_name = '%s_%s_%s_dicoms' % (dcm.StudyID, dcm.SeriesNumber, int(dcm.get('AcquisitionNumber', 1)))
-            else:
-                acq_name = '%s_%s_dicoms' % (dcm.StudyID, dcm.SeriesNumber)
-            acq_path = os.path.join(args.sort_path, dcm.StudyInstanceUID, acq_name)
-            if not os.path.isdir(acq_path):
-                os.makedirs(acq_path)
-            new_filepath = os.path.join(acq_path, os.path.basename(filepath))
-            if not os.path.isfile(new_filepath):
-                if args.verbose:
-                    print 'sorting %s' % filepath
-                os.rename(filepath, new_filepath)
-            elif checksum(filepath) == checksum(new_filepath):
-                print 'deleting duplicate %s' % filepath
-                os.remove(filepath)
+    info(args, 'found %d files to sort (ignoring symlinks%s dotfiles)' % (file_cnt, ', files left by earlier runs and' if args.resume else ' and'))
+
+    # headers are parsed by the pool, but results arrive in input order, so that
+    # renames and duplicate checks happen exactly as they would in a serial run
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(read_routing, files, chunksize=max(1, min(64, file_cnt / (args.jobs * 4))))
+    else:
+        results = (read_routing(filepath) for filepath in files)
+
+    digests = DigestIndex(os.path.join(args.sort_path, DIGEST_INDEX))
+    try:
+        args.progress.begin('sort', total=file_cnt)
+        for i, (filepath, routing) in enumerate(args.progress.timed('parse', results)):
+            if args.verbose:
+                print '%*d/%d' % (cnt_width, i+1, file_cnt),
+            if routing is None:
+                info(args, 'not a DICOM file: %s' % filepath)
+                journal.record('skip', file_key(filepath))
+            elif streams is not None and args.skip_sort_dir:
+                with args.progress.timing('stream', nbytes=os.path.getsize(filepath)):
+                    streamed = streams.get(acquisition_path(args.sort_path, routing)).add(filepath)
+                if not streamed:
+                    info(args, 'not archiving non-identical duplicate %s' % filepath)
+                elif args.verbose:
+                    print 'streaming %s' % filepath
             else:
-                print 'retaining non-identical duplicate %s of %s' % (filepath, new_filepath)
+                acq_path = acquisition_path(args.sort_path, routing)
+                if streams is not None:
+                    streams.get(acq_path)
+                if not os.path.isdir(acq_path):
+                    os.makedirs(acq_path)
+                new_filepath = os.path.join(acq_path, os.path.basename(filepath))
+                if not os.path.isfile(new_filepath):
+                    if args.verbose:
+                        print 'sorting %s' % filepath
+                    with args.progress.timing('move'):
+                        os.rename(filepath, new_filepath)
+                    if streams is not None:
+                        with args.progress.timing('stream', nbytes=os.path.getsize(new_filepath)):
+                            streams.get(acq_path).add(new_filepath)
+                else:
+                    with args.progress.timing('hash'):
+                        identical = digests.identical(filepath, new_filepath)
+                    if identical:
+                        info(args, 'deleting duplicate %s' % filepath)
+                        digests.forget(filepath)
+                        os.remove(filepath)
+                    else:
+                        info(args, 'retaining non-identical duplicate %s of %s' % (filepath, new_filepath))
+                        journal.record('skip', file_key(filepath))
+            args.progress.advance()
+        args.progress.end()
+    finally:
+        # commit the digests and journal entries so far, also when interrupted
+        digests.close()
+        journal.close()
+    if pool:
+        pool.close()
+        pool.join()
 
 
 def tar(args):
@@ -107,34 +455,68 @@ def tar(args):
         print 'error: tar_path is not a writable directory'
 
     dirs = []
-    print 'inspecting %s' % args.sort_path
-    for dirpath, dirnames, filenames in os.walk(args.sort_path):
-	if not dirnames and not os.path.basename(dirpath).startswith('.') and not os.path.islink(dirpath):
-	    dirs.append(dirpath)
+    info(args, 'inspecting %s' % args.sort_path)
+    args.progress.begin('walk_sorted')
+    for dirpath in dirscan.leaf_dirs(args.sort_path, jobs=args.jobs):
+        if not os.path.basename(dirpath).startswith('.'):
+            dirs.append(dirpath)
+            args.progress.advance()
+    args.progress.end()
     dir_cnt = len(dirs)
     cnt_width = len(str(dir_cnt))
 
-    print 'found %d directories to compress (ignoring symlinks and dotfiles)' % dir_cnt
-    time.sleep(2)
-    metadata = {'filetype': 'dicom'}
-    if args.group:
-        if not args.project:
-            args.project='unknown'
-        overwrite = {'overwrite': { 'group_name': args.group, 'project_name': args.project }}
-        metadata.update(overwrite)
-    for i, dirpath in enumerate(dirs):
-	dirname = os.path.basename(dirpath)
-	dir_relpath = os.path.relpath(dirpath, args.sort_path)
+    info(args, 'found %d directories to compress (ignoring symlinks and dotfiles)' % dir_cnt)
+    metadata = series_metadata(args)
+    compressor = resolve_compressor(args.compressor)
+    extension = COMPRESSORS[compressor][0]
+    tasks = []
+    for dirpath in dirs:
+        dir_relpath = os.path.relpath(dirpath, args.sort_path)
+        archive_path = os.path.join(args.tar_path, dir_relpath.replace('/', '_') + extension)
+        update_json_file(dirpath + '/metadata.json', metadata)
+        if dirpath in getattr(args, 'streamed', ()) or (args.resume and up_to_date(archive_path, dirpath)):
+            if args.verbose:
+                print 'skipping up-to-date %s' % dir_relpath
+            continue
+        tasks.append((dirpath, archive_path, compressor, args.compresslevel))
+
+    # one series archive per worker; completion order does not matter here
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap_unordered(archive_series, tasks)
+    else:
+        results = (archive_series(task) for task in tasks)
+
+    args.progress.begin('compress', total=len(tasks))
+    for i, (dirpath, archive_path, nbytes) in enumerate(results):
         if args.verbose:
-            print '%*d/%d compressing %s' % (cnt_width, i+1, dir_cnt, dir_relpath)
-        write_json_file(dirpath + '/metadata.json', metadata)
-        create_archive(os.path.join(args.tar_path, dir_relpath.replace('/', '_') + '.tgz'), dirpath, dirname, compresslevel=6)
+            print '%*d/%d compressed %s' % (cnt_width, i+1, len(tasks), os.path.relpath(dirpath, args.sort_path))
+        args.progress.advance(nbytes=nbytes)
+    args.progress.end()
+    if pool:
+        pool.close()
+        pool.join()
 
 
 def tarsort(args):
-    sort(args)
-    print
-    tar(args)
+    if not args.stream:
+        sort(args)
+        info(args, '')
+        tar(args)
+        return
+
+    if not os.path.isdir(args.tar_path):
+        os.makedirs(args.tar_path)
+    streams = SeriesStreams(args, series_metadata(args))
+    sort(args, streams)
+    streams.finish()
+    if not args.skip_sort_dir:
+        # archive series of earlier runs that no file was added to; the streamed ones are up-to-date
+        info(args, '')
+        args.resume = True
+        args.streamed = set(streams.archives)
+        tar(args)
 
 
 parser = argparse.ArgumentParser()
@@ -147,6 +529,10 @@ sort_parser = subparsers.add_parser(
 sort_parser.add_argument('path', help='input path of unsorted data')
 sort_parser.add_argument('sort_path', help='output path for sorted data')
 sort_parser.add_argument('-v','--verbose', action='store_true', help='provide stream of files as they are sorted')
+sort_parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes used to parse dicom headers [default=1]')
+sort_parser.add_argument('--resume', action='store_true', help='skip work recorded by an interrupted or earlier run')
+sort_parser.add_argument('-q', '--quiet', action='store_true', help='only print errors, no status lines')
+sort_parser.add_argument('--stats-json', metavar='PATH', help='write timings and throughput of each phase to PATH as json')
 sort_parser.set_defaults(func=sort)
 
 tar_parser = subparsers.add_parser(
@@ -158,6 +544,12 @@ tar_parser.add_argument('tar_path', help='output path for tar\'ed data')
 tar_parser.add_argument('--group', type=str,  help='name of group to sort data into')
 tar_parser.add_argument('--project', type=str, help='name of project to sort data into')
 tar_parser.add_argument('-v','--verbose', action='store_true', help='provide stream of tar files as they are tar\'d' )
+tar_parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes used to compress series [default=1]')
+tar_parser.add_argument('--compressor', choices=sorted(COMPRESSORS), default='gzip', help='gzip (built-in), or the multi-threaded pigz or zstd commands if installed [default=gzip]')
+tar_parser.add_argument('--compresslevel', type=int, default=6, help='compression level passed to the compressor [default=6]')
+tar_parser.add_argument('--resume', action='store_true', help='skip series whose archive is newer than all of its files')
+tar_parser.add_argument('-q', '--quiet', action='store_true', help='only print errors, no status lines')
+tar_parser.add_argument('--stats-json', metavar='PATH', help='write timings and throughput of each phase to PATH as json')
 tar_parser.set_defaults(func=tar)
 
 tarsort_parser = subparsers.add_parser(
@@ -170,7 +562,22 @@ tarsort_parser.add_argument('tar_path', help='output path for tar\'ed data')
 tarsort_parser.add_argument('--group', type=str, help='name of group to sort data into')
 tarsort_parser.add_argument('--project', type=str, help='name of project to sort data into')
 tarsort_parser.add_argument('-v','--verbose', action='store_true', help='provide stream of files as they are sorted')
+tarsort_parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes used to parse dicom headers and compress series [default=1]')
+tarsort_parser.add_argument('--compressor', choices=sorted(COMPRESSORS), default='gzip', help='gzip (built-in), or the multi-threaded pigz or zstd commands if installed [default=gzip]')
+tarsort_parser.add_argument('--compresslevel', type=int, default=6, help='compression level passed to the compressor [default=6]')
+tarsort_parser.add_argument('--resume', action='store_true', help='skip work recorded by an interrupted or earlier run')
+tarsort_parser.add_argument('--stream', action='store_true', help='append each sorted file to its series tgz right away, instead of tar\'ing after sorting; gzip only')
+tarsort_parser.add_argument('--max-open', type=int, default=64, help='with --stream, number of series tgz kept open at a time [default=64]')
+tarsort_parser.add_argument('--skip-sort-dir', action='store_true', help='with --stream, leave files in place instead of moving them to sort_path')
+tarsort_parser.add_argument('-q', '--quiet', action='store_true', help='only print errors, no status lines')
+tarsort_parser.add_argument('--stats-json', metavar='PATH', help='write timings and throughput of each phase to PATH as json')
 tarsort_parser.set_defaults(func=tarsort)
 
-args = parser.parse_args()
-args.func(args)
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.func is tarsort and args.stream and args.compressor != 'gzip':
+        parser.error('--stream always compresses with gzip, not with --compressor %s' % args.compressor)
+    args.progress = progress.Progress(quiet=args.quiet)
+    args.func(args)
+    if args.stats_json:
+        args.progress.write_json(args.stats_json)
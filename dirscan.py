@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Directory tree scanning based on scandir.
+
+Uses os.scandir (Python 3.5+) or the scandir backport (in requirements.txt,
+needed on Python 2), so that file types come from the directory entries instead
+of an extra stat call per entry. Without either, it falls back to os.listdir and
+one os.lstat per entry, even with stat=False, which is no faster than os.walk.
+Entries are yielded in the same order os.walk would list them, as lightweight
+records.
+
+example usage:
+    for entry in scan('/path/to/tree', stat=False):
+        if not entry.is_link:
+            print entry.path
+
+"""
+
+import os
+import stat as stat_
+import collections
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# size and mtime are None when scanning with stat=False
+Entry = collections.namedtuple('Entry', ['path', 'size', 'mtime', 'is_link', 'is_dir'])
+
+
+def list_dir(path, stat=True):
+    """Return the (files, dirs) Entry lists of directory path; symlinks to directories count as dirs, like os.walk."""
+    files = []
+    dirs = []
+    if scandir is not None:
+        for dir_entry in scandir(path):
+            size = mtime = None
+            if stat:
+                st = dir_entry.stat(follow_symlinks=False)
+                size, mtime = st.st_size, st.st_mtime
+            is_dir = dir_entry.is_dir()
+            entry = Entry(dir_entry.path, size, mtime, dir_entry.is_symlink(), is_dir)
+            (dirs if is_dir else files).append(entry)
+    else:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            st = os.lstat(entry_path)
+            is_link = stat_.S_ISLNK(st.st_mode)
+            is_dir = os.path.isdir(entry_path) if is_link else stat_.S_ISDIR(st.st_mode)
+            entry = Entry(entry_path, st.st_size if stat else None, st.st_mtime if stat else None, is_link, is_dir)
+            (dirs if is_dir else files).append(entry)
+    return files, dirs
+
+
+def scan(root, files=True, dirs=False, stat=True, jobs=1):
+    """
+    Yield Entry records under root, files and/or dirs, in os.walk order.
+
+    Symlinked directories are yielded but not descended into. With jobs > 1,
+    the subtrees of root are scanned by a thread pool, one per subdirectory;
+    the order of the records stays the same.
+    """
+    try:
+        root_files, root_dirs = list_dir(root, stat)
+    except OSError:
+        return      # unreadable directories are skipped, like os.walk does
+    if files:
+        for entry in root_files:
+            yield entry
+    if dirs:
+        for entry in root_dirs:
+            yield entry
+    subdirs = [entry.path for entry in root_dirs if not entry.is_link]
+    if jobs > 1 and len(subdirs) > 1:
+        pool = ThreadPool(min(jobs, len(subdirs)))
+        try:
+            subtrees = pool.imap(lambda path: list(scan(path, files, dirs, stat)), subdirs)
+            for subtree in subtrees:
+                for entry in subtree:
+                    yield entry
+        finally:
+            pool.terminate()
+    else:
+        for path in subdirs:
+            for entry in scan(path, files, dirs, stat):
+                yield entry
+
+
+def leaf_dirs(root, jobs=1):
+    """Return root, or the directories under root, that have no subdirectories, in os.walk order."""
+    try:
+        subdirs = list_dir(root, stat=False)[1]
+    except OSError:
+        return []
+    if not subdirs:
+        return [root]
+    # like os.walk, a symlinked directory makes its parent a non-leaf, but is not descended into
+    subdirs = [entry.path for entry in subdirs if not entry.is_link]
+    if jobs > 1 and len(subdirs) > 1:
+        pool = ThreadPool(min(jobs, len(subdirs)))
+        try:
+            subtrees = pool.map(leaf_dirs, subdirs)
+        finally:
+            pool.terminate()
+    else:
+        subtrees = [leaf_dirs(path) for path in subdirs]
+    return [path for subtree in subtrees for path in subtree]
@@ -2,6 +2,7 @@
 
 import os
 import json
+import dirscan
 import datetime
 
 # Build dict of types, which maps extensions to known data types
@@ -40,9 +41,8 @@ def meta_create(outbase):
 
     # Build a dict of output file names and data types
     output_files = [
-        os.path.relpath(os.path.join(root, file), outbase)
-        for root, dirs, files in os.walk(outbase)
-        for file in files
+        os.path.relpath(entry.path, outbase)
+        for entry in dirscan.scan(outbase, stat=False)
     ]
     files = []
     if len(output_files) > 0:
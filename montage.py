@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+In-process image montages, laid out like ImageMagick's `montage -geometry +4+4`.
+
+Images are placed in a grid of ceil(sqrt(N)) columns, in the given order. Every
+tile is as large as the largest image, plus a 4 pixel border on each side, and
+each image is centered in its tile on a white background. A whole batch of
+montages shares one thread pool that decodes the images (PIL releases the GIL
+while decoding), so screen saves of many folders or sessions can be built in
+one go, without a process per montage.
+
+Requires Pillow; Image is None when it is not installed.
+
+example usage:
+    build_montages([(['/path/a.png', '/path/b.png'], '/path/montage.png')])
+
+"""
+
+import math
+from multiprocessing.pool import ThreadPool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+SPACING = 4
+BACKGROUND = 'white'
+THREADS = 4
+
+
+def decode(path):
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+def build_montage(images, out_path, spacing=SPACING):
+    """Write a montage of the decoded images to out_path."""
+    columns = int(math.ceil(math.sqrt(len(images))))
+    rows = int(math.ceil(len(images) / float(columns)))
+    tile_width = max(image.size[0] for image in images) + 2 * spacing
+    tile_height = max(image.size[1] for image in images) + 2 * spacing
+    montage = Image.new('RGB', (columns * tile_width, rows * tile_height), BACKGROUND)
+    for i, image in enumerate(images):
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGBA')
+        row, column = divmod(i, columns)
+        x = column * tile_width + (tile_width - image.size[0]) // 2
+        y = row * tile_height + (tile_height - image.size[1]) // 2
+        montage.paste(image, (x, y), image if image.mode == 'RGBA' else None)
+    montage.save(out_path)
+
+
+def build_montages(jobs, threads=THREADS, spacing=SPACING):
+    """
+    Build each (image_paths, out_path) montage in jobs, with one thread pool for the whole batch.
+
+    The images of one montage are decoded in parallel, so only one montage's
+    images are held in memory at a time.
+    """
+    jobs = [(paths, out_path) for paths, out_path in jobs if paths]
+    if not jobs:
+        return
+    pool = ThreadPool(threads)
+    try:
+        for paths, out_path in jobs:
+            build_montage(pool.map(decode, paths), out_path, spacing)
+    finally:
+        pool.terminate()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Helpers of siemens_multicoil.py that need neither scitran.data nor dcmstack.
+
+cal_min and cal_max of the merged nifti are the 10th and 99.5th percentiles of
+its data. clip_values computes them exactly; PercentileEstimator estimates them
+from data that is added one volume at a time, from a strided sample or a
+streaming histogram.
+
+series_info and pair_series find the individual and combined coil series
+among the archives of a dicomsort.py tar output path.
+
+example usage:
+    estimator = PercentileEstimator('histogram')
+    for i in range(data.shape[3]):
+        estimator.add(data[..., i])
+    cal_min, cal_max = estimator.result()
+
+"""
+
+import os
+import tarfile
+import logging
+import collections
+import numpy as np
+
+import dicomheader
+
+log = logging.getLogger(__name__)
+
+CLIP_PERCENTILES = (10.0, 99.5)     # of the data, for cal_min and cal_max
+SAMPLE_STEP = 97                    # keep every 97th value for 'sample' percentiles
+HISTOGRAM_BINS = 2 ** 16            # bins for 'histogram' percentiles
+SERIES_KEYWORDS = ['StudyInstanceUID', 'SeriesNumber', 'SeriesDescription']
+
+Series = collections.namedtuple('Series', ['path', 'study_uid', 'series_no', 'description', 'images'])
+
+
+def clip_values(data):
+    """Return the 10th and 99.5th percentiles of data (or of its magnitude, if complex), for cal_min and cal_max."""
+    if np.iscomplexobj(data):
+        clip_vals = np.percentile(np.abs(data), CLIP_PERCENTILES)
+    else:
+        clip_vals = np.percentile(data, CLIP_PERCENTILES)
+    log.info('cal_min %g, cal_max %g (exact percentiles)' % tuple(clip_vals))
+    return clip_vals
+
+
+class PercentileEstimator(object):
+
+    """
+    Approximate the clip percentiles of data that is added one volume at a time.
+
+    'sample' keeps every SAMPLE_STEP-th value; its reported error is the spread of
+    the sample percentiles within two standard errors of the rank, i.e. a ~95%
+    bound. 'histogram' counts the values into HISTOGRAM_BINS equal bins whose
+    range doubles whenever a volume falls outside it; the values around each
+    percentile are taken as the centers of their bins, so the error is at most
+    one bin width. Complex data is replaced by its magnitude, as in clip_values.
+    """
+
+    def __init__(self, mode='histogram', percentiles=CLIP_PERCENTILES):
+        if mode not in ('sample', 'histogram'):
+            raise ValueError('unknown percentile mode %s' % mode)
+        self.mode = mode
+        self.percentiles = percentiles
+        self.samples = []
+        self.counts = None
+        self.low = None
+        self.width = None
+        self.error = None   # absolute error bound of the last result()
+
+    def add(self, volume):
+        volume = np.abs(volume) if np.iscomplexobj(volume) else np.asarray(volume)
+        volume = volume.ravel(order='K')
+        if self.mode == 'sample':
+            self.samples.append(np.array(volume[::SAMPLE_STEP]))
+            return
+        vmin, vmax = float(volume.min()), float(volume.max())
+        if self.counts is None:
+            self.counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+            self.low = vmin
+            self.width = max(vmax - vmin, abs(vmin) * 1e-6, 1e-12) / HISTOGRAM_BINS
+        while vmin < self.low or vmax > self.low + self.width * HISTOGRAM_BINS:
+            # merge pairs of bins to double the range, growing it towards the new values
+            pairs = self.counts.reshape(-1, 2).sum(axis=1)
+            self.counts[:] = 0
+            if vmin < self.low:
+                self.counts[HISTOGRAM_BINS // 2:] = pairs
+                self.low -= self.width * HISTOGRAM_BINS
+            else:
+                self.counts[:HISTOGRAM_BINS // 2] = pairs
+            self.width *= 2
+        bins = ((volume - self.low) / self.width).astype(np.int64)
+        self.counts += np.bincount(np.clip(bins, 0, HISTOGRAM_BINS - 1), minlength=HISTOGRAM_BINS)
+
+    def result(self):
+        """Return the estimated percentiles, and log them with their absolute error."""
+        if self.mode == 'sample':
+            sample = np.concatenate(self.samples)
+            values = np.percentile(sample, self.percentiles)
+            errors = []
+            for p, value in zip(self.percentiles, values):
+                se = 100. * np.sqrt(p / 100. * (1 - p / 100.) / len(sample))
+                bounds = np.percentile(sample, (max(0., p - 2 * se), min(100., p + 2 * se)))
+                errors.append(np.max(np.abs(bounds - value)))
+            error = max(errors)
+        else:
+            # like np.percentile, interpolate between the two values around the rank; each is
+            # taken as the center of its bin, so it is off by at most half a bin
+            cumulative = np.cumsum(self.counts)
+            center = lambda k: self.low + self.width * (np.searchsorted(cumulative, k + 1) + 0.5)
+            values = []
+            for p in self.percentiles:
+                rank = p / 100. * (cumulative[-1] - 1)
+                k = int(rank)
+                value = center(k)
+                if k + 1 < cumulative[-1]:
+                    value += (rank - k) * (center(k + 1) - value)
+                values.append(value)
+            values = np.array(values)
+            error = self.width
+        self.error = error
+        log.info('cal_min %g, cal_max %g (%s percentiles, absolute error <= %g)' % (values[0], values[1], self.mode, error))
+        return values
+
+
+def series_info(path):
+    """Return the Series of one dicomsort series archive, from its first dicom header, or None if it has no dicoms."""
+    header = None
+    images = 0
+    with tarfile.open(path, 'r:gz') as archive:
+        for member in archive:
+            if not member.isfile() or os.path.basename(member.name) == 'metadata.json':
+                continue
+            if header is None:
+                try:
+                    header = dicomheader.read_header(archive.extractfile(member), SERIES_KEYWORDS)
+                except dicomheader.InvalidDicomError:
+                    continue
+            images += 1
+        # tarfile stops quietly at a truncated member header; reading to the end of the gzip stream raises instead
+        archive.fileobj.seek(archive.offset)
+        while archive.fileobj.read(1024 * 1024):
+            pass
+    if header is None:
+        return None
+    return Series(path, str(header.StudyInstanceUID), int(header.SeriesNumber),
+                  str(header.get('SeriesDescription', '')), images)
+
+
+def pair_series(series):
+    """
+    Return the (individual, combined) coil Series pairs of series, and the Series that are not paired.
+
+    Siemens saves the combined coil images as the series following the
+    individual coil images, with the same description; the individual coil
+    series is the one with more images.
+    """
+    pairs = []
+    unpaired = []
+    by_study = collections.defaultdict(list)
+    for info in series:
+        by_study[info.study_uid].append(info)
+    for study_uid in sorted(by_study):
+        study = sorted(by_study[study_uid], key=lambda info: info.series_no)
+        i = 0
+        while i < len(study):
+            first = study[i]
+            second = study[i + 1] if i + 1 < len(study) else None
+            if (second and second.series_no == first.series_no + 1 and second.description == first.description
+                    and second.images != first.images):
+                pairs.append((first, second) if first.images > second.images else (second, first))
+                i += 2
+            else:
+                unpaired.append(first)
+                i += 1
+    return pairs, unpaired
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Progress and throughput reporting for long running batch utilities.
+
+Work is counted per phase (e.g. walk, parse, move, hash, compress). The phase
+that is currently being worked through prints a status line at most once per
+interval, with items/s, MB/s and an ETA when the total is known. Helper phases
+that are interleaved with it are only timed. summary() returns the numbers of
+all phases, for writing as json at the end of a run.
+
+example usage:
+    progress = Progress()
+    progress.begin('compress', total=len(dirs))
+    for d in dirs:
+        with progress.timing('hash', nbytes=size):
+            ...
+        progress.advance(nbytes=size)
+    progress.end()
+    progress.write_json('stats.json')
+
+"""
+
+import sys
+import json
+import time
+import contextlib
+import collections
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class Progress(object):
+
+    """Per-phase counters and timers, with rate-limited status lines."""
+
+    def __init__(self, quiet=False, interval=2.0, stream=None):
+        self.quiet = quiet
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.phases = collections.OrderedDict()
+        self.current = None
+        self.started = None
+        self.last_report = 0
+
+    def _phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = {'count': 0, 'bytes': 0, 'seconds': 0., 'total': None}
+        return self.phases[name]
+
+    def begin(self, name, total=None):
+        """Start the main phase name; total, if known, enables the ETA."""
+        if self.current:
+            self.end()
+        self._phase(name)['total'] = total
+        self.current = name
+        self.started = self.last_report = time.time()
+
+    def advance(self, count=1, nbytes=0):
+        phase = self.phases[self.current]
+        phase['count'] += count
+        phase['bytes'] += nbytes
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(self.current, now - self.started)
+
+    def end(self):
+        if not self.current:
+            return
+        elapsed = time.time() - self.started
+        self.phases[self.current]['seconds'] += elapsed
+        self.report(self.current, elapsed, done=True)
+        self.current = None
+
+    @contextlib.contextmanager
+    def timing(self, name, count=1, nbytes=0):
+        """Time a helper phase that runs in between advances of the main one."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            phase = self._phase(name)
+            phase['seconds'] += time.time() - start
+            phase['count'] += count
+            phase['bytes'] += nbytes
+
+    def timed(self, name, iterable):
+        """Yield from iterable, timing each step as helper phase name; e.g. waiting on a pool."""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            phase = self._phase(name)
+            phase['seconds'] += time.time() - start
+            phase['count'] += 1
+            yield item
+
+    def report(self, name, elapsed, done=False):
+        if self.quiet:
+            return
+        phase = self.phases[name]
+        status = '%s: %d' % (name, phase['count'])
+        if phase['total'] is not None:
+            status += '/%d' % phase['total']
+        if elapsed > 0:
+            status += ', %.1f/s' % (phase['count'] / elapsed)
+            if phase['bytes']:
+                status += ', %.1f MB/s' % (phase['bytes'] / elapsed / 1e6)
+        if done:
+            status += ', done in %s' % format_duration(elapsed)
+        elif phase['total'] and phase['count']:
+            remaining = (phase['total'] - phase['count']) * elapsed / phase['count']
+            status += ', ETA %s' % format_duration(remaining)
+        self.stream.write(status + '\n')
+        self.stream.flush()
+
+    def summary(self):
+        summary = collections.OrderedDict()
+        for name, phase in self.phases.iteritems():
+            stats = summary[name] = collections.OrderedDict()
+            stats['count'] = phase['count']
+            stats['bytes'] = phase['bytes']
+            stats['seconds'] = round(phase['seconds'], 3)
+            if phase['seconds'] > 0:
+                stats['per_second'] = round(phase['count'] / phase['seconds'], 1)
+                stats['mb_per_second'] = round(phase['bytes'] / phase['seconds'] / 1e6, 1)
+        return summary
+
+    def write_json(self, path):
+        with open(path, 'w') as json_file:
+            json.dump(self.summary(), json_file, indent=2)
+            json_file.write('\n')
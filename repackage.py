@@ -9,11 +9,17 @@ example usage:
 from __future__ import print_function
 
 import os
+import io
+import sys
 import glob
 import json
+import time
 import tarfile
 import calendar
 import datetime
+import traceback
+import collections
+import multiprocessing
 
 
 def datetime_encoder(o):
@@ -30,19 +36,38 @@ def datetime_decoder(dct):
     return dct
 
 
+def build_metadata(args, existing_metadata=None):
+    """Return the metadata of a repackaged archive; existing metadata of the archive takes precedence."""
+    metadata = {'filetype': 'dicom'}
+    if args and args.group:
+        metadata['overwrite'] = {'group_name': args.group, 'project_name': args.project or 'unknown'}
+    if existing_metadata:
+        metadata.update(existing_metadata)
+    return metadata
+
+
+def dump_metadata(metadata):
+    return json.dumps(metadata, default=datetime_encoder) + '\n'
+
+
+def digest_filenames(filenames):
+    """Return the top-level filenames of an archive in digest order: .json files, then .txt files, then the rest, each by name."""
+    filenames = set(filenames) | {'METADATA.json', 'DIGEST.txt'}
+    return sorted(filenames, key=lambda fn: ((fn.endswith('.json') and 1) or (fn.endswith('.txt') and 2) or 3, fn))
+
+
 def create_archive(path, content, arcname, metadata={}, **kwargs):
     # write metadata file
     metadata_filepath = os.path.join(content, 'METADATA.json')
+    metadata = dict(metadata)
     if os.path.exists(metadata_filepath):
         existing_metadata = json.load(open(metadata_filepath), object_hook=datetime_decoder)
         metadata.update(existing_metadata)
     with open(metadata_filepath, 'w') as json_file:
-        json.dump(metadata, json_file, default=datetime_encoder)
-        json_file.write('\n')
+        json_file.write(dump_metadata(metadata))
     # write digest file
     digest_filepath = os.path.join(content, 'DIGEST.txt')
-    open(digest_filepath, 'w').close()  # touch file, so that it's included in the digest
-    filenames = sorted(os.listdir(content), key=lambda fn: (fn.endswith('.json') and 1) or (fn.endswith('.txt') and 2) or fn)
+    filenames = digest_filenames(os.listdir(content))
     with open(digest_filepath, 'w') as digest_file:
         digest_file.write('\n'.join(filenames) + '\n')
     # create archive
@@ -60,20 +85,141 @@ def repackage(dcmtgz, outdir=None, args=None):
         outname = os.path.join(outdir, outname)
     if os.path.exists(outname):
         print ('%s exists! We will replace it.' % outname)
+    if getattr(args, 'stream', False):
+        print ('repackaging %s to %s' % (dcmtgz, outname))
+        stream_repackage(dcmtgz, outname, args)
+        return
     with TemporaryDirectory() as tempdir_path:
         with tarfile.open(dcmtgz) as archive:
             archive.extractall(path=tempdir_path)
         dcm_dir = glob.glob(os.path.join(tempdir_path, '*'))[0]
-        metadata = {'filetype': 'dicom'}
-        if args.group:
-            if not args.project:
-                args.project='unknown'
-            overwrite = {'overwrite': { 'group_name': args.group, 'project_name': args.project }}
-        metadata.update(overwrite)
+        metadata = build_metadata(args)
         basename = os.path.basename(dcm_dir)
         print ('repackaging %s to %s' % (dcmtgz, outname))
         create_archive(outname, dcm_dir, basename, metadata, compresslevel=6)
 
+
+def split_member_name(name):
+    """Return (top-level folder, path below it) of a member name."""
+    parts = name.strip('/').split('/', 1)
+    return parts[0], parts[1] if len(parts) > 1 else ''
+
+
+def stream_repackage(dcmtgz, outname, args=None, compresslevel=6):
+    """
+    Repackage dcmtgz to outname like repackage, without extracting it.
+
+    The first pass reads the member list and the existing METADATA.json; the
+    second copies the members straight into the new archive, after the
+    top-level folder and the new METADATA.json and DIGEST.txt. The other
+    members keep their order. The archive is written to outname.part and
+    renamed when complete, so outname may be dcmtgz itself. dcmtgz is opened
+    for random access, because streaming reads stop at the end of the first
+    member of a multi-member gzip file.
+    """
+    arcname = None
+    filenames = []
+    existing_metadata = None
+    with tarfile.open(dcmtgz, 'r:*') as archive:
+        members = archive.getmembers()
+        for member in members:
+            top, relpath = split_member_name(member.name)
+            arcname = arcname or top
+            if top != arcname or not relpath:
+                continue
+            filenames.append(relpath.split('/')[0])
+            if relpath == 'METADATA.json' and member.isfile():
+                existing_metadata = json.load(archive.extractfile(member), object_hook=datetime_decoder)
+        if arcname is None:
+            raise tarfile.ReadError('%s is empty' % dcmtgz)
+
+        now = time.time()
+        contents = [
+            ('METADATA.json', dump_metadata(build_metadata(args, existing_metadata)).encode('utf-8')),
+            ('DIGEST.txt', ('\n'.join(digest_filenames(filenames)) + '\n').encode('utf-8')),
+        ]
+        replaced = dict(contents)
+        with tarfile.open(outname + '.part', 'w:gz', compresslevel=compresslevel) as new_archive:
+            top_dir = None
+            for member in members:
+                top, relpath = split_member_name(member.name)
+                if top != arcname:
+                    continue
+                if top_dir is None:
+                    top_dir = member if not relpath and member.isdir() else new_tarinfo(arcname, now, tarfile.DIRTYPE)
+                    new_archive.addfile(top_dir)
+                    for fn, content in contents:
+                        tarinfo = new_tarinfo(arcname + '/' + fn, now)
+                        tarinfo.size = len(content)
+                        new_archive.addfile(tarinfo, io.BytesIO(content))
+                if not relpath or relpath in replaced:
+                    continue
+                new_archive.addfile(member, archive.extractfile(member) if member.isfile() else None)
+    os.rename(outname + '.part', outname)
+
+
+def peek_metadata(dcmtgz):
+    """Return the top-level METADATA.json of dcmtgz, reading only up to that member, or None if there is none."""
+    with tarfile.open(dcmtgz, 'r:*') as archive:
+        for member in archive:
+            top, relpath = split_member_name(member.name)
+            if relpath == 'METADATA.json' and member.isfile():
+                return json.load(archive.extractfile(member), object_hook=datetime_decoder)
+    return None
+
+
+def repackage_task(task):
+    """
+    Pool worker: repackage one archive, unless its output is already tagged with the requested group and project.
+
+    Returns (dcmtgz, status, message), status being 'repackaged', 'skipped' or 'failed'.
+    """
+    dcmtgz, outdir, args = task
+    try:
+        outname = os.path.join(outdir, os.path.basename(dcmtgz)) if outdir else os.path.basename(dcmtgz)
+        if args.group and os.path.exists(outname):
+            metadata = peek_metadata(outname) or {}
+            if metadata.get('overwrite') == build_metadata(args)['overwrite']:
+                return (dcmtgz, 'skipped', 'already tagged %(group_name)s/%(project_name)s' % metadata['overwrite'])
+        repackage(dcmtgz, outdir, args)
+        return (dcmtgz, 'repackaged', outname)
+    except Exception as e:
+        return (dcmtgz, 'failed', traceback.format_exception_only(type(e), e)[-1].strip())
+
+
+def batch_repackage(paths, outdir=None, args=None):
+    """Repackage paths with args.jobs processes, print a line per archive and a summary, and return the results."""
+    if outdir and not os.path.exists(outdir):
+        os.makedirs(outdir)     # before the workers race to create it
+    tasks = [(path, outdir, args) for path in paths]
+    pool = None
+    if args.jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(tasks)))
+        results = pool.imap_unordered(repackage_task, tasks)
+    else:
+        results = (repackage_task(task) for task in tasks)
+    summary = collections.Counter()
+    all_results = []
+    for dcmtgz, status, message in results:
+        print ('%s %s: %s' % (status, dcmtgz, message))
+        summary[status] += 1
+        all_results.append((dcmtgz, status, message))
+    if pool:
+        pool.close()
+        pool.join()
+    print ('%d archives: %d repackaged, %d skipped, %d failed' % (len(tasks), summary['repackaged'], summary['skipped'], summary['failed']))
+    return all_results
+
+
+def new_tarinfo(name, mtime, filetype=tarfile.REGTYPE):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.type = filetype
+    tarinfo.mode = 0o755 if filetype == tarfile.DIRTYPE else 0o644
+    tarinfo.mtime = mtime
+    tarinfo.uid = os.getuid()
+    tarinfo.gid = os.getgid()
+    return tarinfo
+
 """This is a backport of TemporaryDirectory from Python 3.3."""
 
 
@@ -176,6 +322,9 @@ if __name__ == '__main__':
     ap.add_argument('-o', '--output_dir', help='output into this directory, will create if doesn not exist')
     ap.add_argument('-g', '--group', type=str,  help='name of group to sort data into')
     ap.add_argument('-p', '--project', type=str, help='name of project to sort data into')
+    ap.add_argument('--stream', action='store_true', help='copy the archive members straight into the new archive, without extracting them')
+    ap.add_argument('-j', '--jobs', type=int, default=1, help='number of archives repackaged in parallel [default=1]')
+    ap.add_argument('--report', metavar='PATH', help='write the result of each archive to PATH as json')
     args = ap.parse_args()
 
     outdir = None
@@ -183,8 +332,14 @@ if __name__ == '__main__':
         outdir = os.path.abspath(args.output_dir)
         print ('outputting to %s' % outdir)
 
+    results = []
     if os.path.isdir(args.target):
-        for f in glob.glob(os.path.join(args.target, '*.tgz')):
-            repackage(f, args.output_dir, args)
+        results = batch_repackage(sorted(glob.glob(os.path.join(args.target, '*.tgz'))), outdir, args)
     elif os.path.isfile(args.target):
-        repackage(args.target, args.output_dir, args)
+        results = batch_repackage([args.target], outdir, args)
+    if args.report:
+        with open(args.report, 'w') as json_file:
+            json.dump([collections.OrderedDict([('archive', path), ('status', status), ('message', message)]) for path, status, message in results], json_file, indent=2)
+            json_file.write('\n')
+    if any(status == 'failed' for _, status, _ in results):
+        sys.exit(1)
@@ -24,11 +24,24 @@ combine niftis
     siemens_multicoil.py ./tar/path/individual_coils_dicoms.tgz ./tar/path/combined_coils_dicoms.tgz
 
 
+combine all pairs of a tar path, pairing series by header fields
+
+.. code-block::bash
+
+    siemens_multicoil.py --batch ./tar/path -j 8 --manifest ./multicoil_manifest.json
+
+
 """
 
 
 import os
+import sys
+import glob
+import gzip
+import json
+import shutil
 import logging
+import multiprocessing
 import nibabel
 import dcmstack
 import warnings
@@ -41,6 +54,7 @@ warnings.simplefilter("ignore", FutureWarning)
 
 import scitran.data as scidata         # use .parse and .write interfaces
 import tempdir as tempfile
+import multicoil
 
 
 class ProcessorError(Exception):
@@ -53,9 +67,10 @@ class ProcessorError(Exception):
 
 class NiftiConcat(object):
 
-    """Convert two tgz to niftis and then merge the two niftis into one."""
+    """Convert tgz inputs to niftis, in parallel, and then merge the niftis into one, in input order."""
 
-    def __init__(self, input_list, outbase, voxel_order='LPS'):
+    def __init__(self, input_list, outbase, voxel_order='LPS', low_memory=False, percentiles=None, jobs=None,
+                 keep_intermediates=False, in_memory=False):
         super(NiftiConcat, self).__init__()
         self.inputs = input_list
         self.outbase = outbase
@@ -64,6 +79,14 @@ class NiftiConcat(object):
                 raise ProcessorError('file %s does not exist. bailing' % f, log_level=logging.ERROR)
         self.voxel_order = voxel_order
         self.outbase = outbase
+        self.low_memory = low_memory
+        # exact percentiles of a memory-mapped output read all of it back into memory
+        self.percentiles = percentiles or ('histogram' if low_memory else 'exact')
+        if low_memory and self.percentiles == 'exact':
+            log.warning('exact percentiles load the whole output into memory, despite low memory mode')
+        self.jobs = jobs or min(len(input_list), multiprocessing.cpu_count())
+        self.keep_intermediates = keep_intermediates
+        self.in_memory = in_memory
         log.info('preparing to reconstruct %s' % str(self.inputs))
 
     def process(self):
@@ -71,22 +94,41 @@ class NiftiConcat(object):
         outfiles = []
         first_tr = None
         with tempfile.TemporaryDirectory(dir=None) as temp_dirpath:
-            for f in self.inputs:
-                fpath = os.path.abspath(f)
-                dcm_ds = scidata.parse(fpath, filetype='dicom', load_data=True, ignore_json=True)
+            # scidata writes the intermediates, unless in_memory images are built from the parsed
+            # dicoms; those are used as they are, or written as uncompressed .nii when they come from
+            # pool workers (instead of being pickled back) or are memory-mapped in low memory mode
+            use_pool = self.jobs > 1 and len(self.inputs) > 1
+            intermediate_dir = temp_dirpath
+            if self.keep_intermediates:
+                intermediate_dir = os.path.dirname(os.path.abspath(self.outbase)) if self.outbase else os.getcwd()
+            if self.keep_intermediates or not self.in_memory:
+                mode = 'write'
+            else:
+                mode = 'nii' if self.low_memory or use_pool else 'memory'
+            # the inputs are independent until the merge; map keeps them in the given order
+            tasks = [(i, os.path.abspath(f), intermediate_dir, self.voxel_order, mode) for i, f in enumerate(self.inputs)]
+            if use_pool:
+                pool = multiprocessing.Pool(min(self.jobs, len(tasks)))
+                try:
+                    results = pool.map(reconstruct, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [reconstruct(task) for task in tasks]
+
+            for label, tr, result in results:
                 if not first_tr:
-                    first_tr = dcm_ds.tr
-                # save info to name this nifti
-                label = '%s_%s' % (dcm_ds.exam_no, dcm_ds.series_no)
-                intermediate = os.path.join(temp_dirpath, '_%s' % label)
+                    first_tr = tr
                 # save info to name the final output
                 if not self.outbase:
                     self.outbase = os.path.join(label + '_multicoil.nii.gz')
-                result = scidata.write(dcm_ds, dcm_ds.data, intermediate, filetype='nifti', voxel_order=self.voxel_order)
-                log.debug('reconstructed nifti: %s' % result)
-                # maintain a list of intermediate files
+                # maintain a list of intermediate files or images
                 outfiles += result
 
+            if self.low_memory:
+                return self.concat_low_memory(outfiles, first_tr, temp_dirpath)
+
             first_nii_header = None
             first_qto_xyz = None    # to be able to check if any is saved at all.
             seq = []
@@ -94,7 +136,8 @@ class NiftiConcat(object):
             # resulting sequence items should have consistent dimensions
             log.debug('combinging niftis: %s' % str(outfiles))
             for f in outfiles:
-                nii = dcmstack.dcmmeta.NiftiWrapper(nibabel.load(f), make_empty=True)
+                nii_img = nibabel.load(f) if isinstance(f, basestring) else f
+                nii = dcmstack.dcmmeta.NiftiWrapper(nii_img, make_empty=True)
                 # store the header from the first outfile
                 if first_nii_header is None:
                     log.debug('storing first input nifti header')
@@ -117,10 +160,13 @@ class NiftiConcat(object):
             nii_header['descrip'] = first_nii_header['descrip']
 
             data = nii_merge.nii_img.get_data()
-            if np.iscomplexobj(data):
-                clip_vals = np.percentile(np.abs(data), (10.0, 99.5))
+            if self.percentiles == 'exact':
+                clip_vals = multicoil.clip_values(data)
             else:
-                clip_vals = np.percentile(data, (10.0, 99.5))
+                estimator = multicoil.PercentileEstimator(self.percentiles)
+                for i in range(data.shape[3] if data.ndim == 4 else 1):
+                    estimator.add(data[..., i] if data.ndim == 4 else data)
+                clip_vals = estimator.result()
             nii_header.structarr['cal_min'] = clip_vals[0]
             nii_header.structarr['cal_max'] = clip_vals[1]
             nii_header['pixdim'][4] = first_tr
@@ -136,20 +182,222 @@ class NiftiConcat(object):
                     return [self.outbase]
 
 
+    def concat_low_memory(self, outfiles, first_tr, temp_dirpath):
+        """
+        Concatenate the volumes of outfiles into self.outbase, holding one volume in memory at a time.
+
+        The output data is preallocated as a memory-mapped .nii in temp_dirpath and
+        filled volume by volume; the header, with cal_min/cal_max from the data, is
+        written last, then the file is gzipped or moved to self.outbase. The output
+        keeps the first input's header without its extensions, because a dcmstack
+        meta extension would no longer match the concatenated data.
+        """
+        if os.path.exists(self.outbase):
+            raise ProcessorError('output file %s already exists. not overwriting. bailing.', log_level=logging.ERROR)
+        log.debug('combining niftis with bounded memory: %s' % str(outfiles))
+        niis = [nibabel.load(f) for f in outfiles]     # headers only, data stays on disk
+        shape = niis[0].shape[:3]
+        n_vols = 0
+        for nii in niis:
+            if nii.shape[:3] != shape or len(nii.shape) > 4:
+                raise ProcessorError('%s has shape %s, expected %s' % (nii.get_filename(), nii.shape, shape), log_level=logging.ERROR)
+            if not np.allclose(nii.affine, niis[0].affine):
+                raise ProcessorError('%s has a different affine than %s' % (nii.get_filename(), niis[0].get_filename()), log_level=logging.ERROR)
+            n_vols += nii.shape[3] if len(nii.shape) == 4 else 1
+
+        header = niis[0].header.copy()
+        del header.extensions[:]
+        if any(nii.dataobj.slope != 1 or nii.dataobj.inter != 0 for nii in niis):
+            header.set_data_dtype(np.float64)   # like get_data(), which applies the scaling
+        else:
+            header.set_data_dtype(np.result_type(*[nii.get_data_dtype() for nii in niis]))
+        header.set_slope_inter(1, 0)
+        header.set_data_shape(shape + (n_vols,))
+        header['pixdim'][4] = first_tr
+        header['vox_offset'] = 0    # set to the minimum when written
+
+        nii_path = os.path.join(temp_dirpath, 'multicoil.nii')
+        with open(nii_path, 'wb') as nii_file:
+            header.write_to(nii_file)   # placeholder, rewritten once cal_min and cal_max are known
+            data_offset = int(header.get_data_offset())
+            nii_file.truncate(data_offset + header.get_data_dtype().itemsize * int(np.prod(shape + (n_vols,))))
+        data = np.memmap(nii_path, dtype=header.get_data_dtype(), mode='r+', offset=data_offset,
+                         shape=shape + (n_vols,), order='F')
+        estimator = multicoil.PercentileEstimator(self.percentiles) if self.percentiles != 'exact' else None
+        vol = 0
+        for nii in niis:
+            for i in range(nii.shape[3] if len(nii.shape) == 4 else 1):
+                data[..., vol] = nii.dataobj[..., i] if len(nii.shape) == 4 else nii.dataobj[...]
+                if estimator:
+                    estimator.add(data[..., vol])
+                vol += 1
+        clip_vals = estimator.result() if estimator else multicoil.clip_values(data)
+        header.structarr['cal_min'] = clip_vals[0]
+        header.structarr['cal_max'] = clip_vals[1]
+        data.flush()
+        del data
+
+        with open(nii_path, 'r+b') as nii_file:
+            header.write_to(nii_file)
+        if self.outbase.endswith('.gz'):
+            with open(nii_path, 'rb') as f_in, gzip.open(self.outbase, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        else:
+            shutil.move(nii_path, self.outbase)
+        log.info('generated %s' % self.outbase)
+        return [self.outbase]
+
+
+def dataset_image(dcm_ds, voxel_order=None):
+    """
+    Return a nifti image of the data and qto_xyz affine of dcm_ds, with its voxels reordered to voxel_order.
+
+    voxel_order gives the directions the voxel axes point towards, e.g. 'LPS'.
+    Returns None unless dcm_ds holds a single data array and an affine. Only
+    the affine (as scanner qform and sform) and the units are set; the other
+    header fields of scidata's nifti writer, such as descrip and slice timing,
+    are not.
+    """
+    data = dcm_ds.data
+    if isinstance(data, dict):
+        data = data.values()[0] if len(data) == 1 else None
+    affine = getattr(dcm_ds, 'qto_xyz', None)
+    if not isinstance(data, np.ndarray) or data.ndim < 3 or affine is None:
+        return None
+    if voxel_order:
+        orientations = nibabel.orientations
+        transform = orientations.ornt_transform(orientations.io_orientation(affine),
+                                                orientations.axcodes2ornt(tuple(voxel_order.upper())))
+        affine = np.dot(affine, orientations.inv_ornt_aff(transform, data.shape[:3]))
+        data = orientations.apply_orientation(data, transform)
+    img = nibabel.Nifti1Image(data, affine)
+    img.set_qform(affine, code='scanner')
+    img.set_sform(affine, code='scanner')
+    img.header.set_xyzt_units('mm', 'sec')
+    return img
+
+
+def reconstruct(task):
+    """
+    Pool worker: reconstruct one input dicoms.tgz to nifti, and return its label, TR and niftis.
+
+    mode 'write' writes the intermediates with scidata.write to intermediate_dir
+    and returns their paths. 'memory' returns the dataset_image of the input,
+    and 'nii' saves it uncompressed to intermediate_dir and returns its path.
+    If the dataset has no dataset_image, its intermediates are written and used
+    as for 'write'.
+    """
+    i, fpath, intermediate_dir, voxel_order, mode = task
+    dcm_ds = scidata.parse(fpath, filetype='dicom', load_data=True, ignore_json=True)
+    # save info to name this nifti; the input's index keeps inputs of the same series apart
+    label = '%s_%s' % (dcm_ds.exam_no, dcm_ds.series_no)
+    intermediate = os.path.join(intermediate_dir, '_%d_%s' % (i, label))
+    img = dataset_image(dcm_ds, voxel_order) if mode != 'write' else None
+    if img is None:
+        result = scidata.write(dcm_ds, dcm_ds.data, intermediate, filetype='nifti', voxel_order=voxel_order)
+    elif mode == 'memory':
+        result = [img]
+    else:
+        img.to_filename(intermediate + '.nii')
+        result = [intermediate + '.nii']
+    log.debug('reconstructed nifti: %s' % result)
+    return label, dcm_ds.tr, result
+
+
+def series_task(path):
+    """Pool worker: return (path, series_info of path, None), or (path, None, error message) if it cannot be read."""
+    try:
+        return (path, multicoil.series_info(path), None)
+    except Exception as e:
+        return (path, None, traceback.format_exception_only(type(e), e)[-1].strip())
+
+
+def concat_pair(task):
+    """Pool worker: merge one (individual, combined) pair; return (individual, combined, status, output or message)."""
+    individual, combined, voxel_order, low_memory, percentiles, keep_intermediates, in_memory = task
+    try:
+        # pool workers cannot start pools of their own, so the inputs are reconstructed one by one
+        n = NiftiConcat([individual, combined], None, voxel_order, low_memory, percentiles, 1, keep_intermediates,
+                        in_memory)
+        n.process()
+        return (individual, combined, 'merged', os.path.abspath(n.outbase))
+    except Exception as e:
+        return (individual, combined, 'failed', traceback.format_exception_only(type(e), e)[-1].strip())
+
+
+def batch_concat(tar_path, args):
+    """
+    Merge all individual and combined coil series pairs of a dicomsort tar path, and return the manifest.
+
+    One pool of args.jobs processes reads the series headers, and then merges
+    the pairs; the outputs are written to the current working directory. Each
+    merge holds both reconstructions of its pair in memory, so args.jobs
+    defaults to 1. Archives that cannot be read are listed as errors.
+    """
+    paths = sorted(glob.glob(os.path.join(tar_path, '*.tgz')))
+    jobs = args.jobs or 1
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        series = []
+        errors = []
+        for path, info, error in (pool.map if pool else map)(series_task, paths):
+            if error:
+                log.error('cannot read %s: %s' % (path, error))
+                errors.append({'path': path, 'error': error})
+            elif info:
+                series.append(info)
+        pairs, unpaired = multicoil.pair_series(series)
+        log.info('found %d series in %s: %d pairs, %d unpaired, %d unreadable' % (len(paths), tar_path, len(pairs), len(unpaired), len(errors)))
+        tasks = [(individual.path, combined.path, args.voxel_order, args.low_memory, args.percentiles, args.keep_intermediates,
+                  args.in_memory)
+                 for individual, combined in pairs]
+        results = pool.imap_unordered(concat_pair, tasks) if pool else (concat_pair(task) for task in tasks)
+        manifest = {'pairs': [], 'unpaired': [info.path for info in unpaired], 'errors': errors}
+        for individual, combined, status, message in results:
+            (log.info if status == 'merged' else log.error)('%s %s + %s: %s' % (status, os.path.basename(individual), os.path.basename(combined), message))
+            entry = {'individual': individual, 'combined': combined, 'status': status}
+            entry['output' if status == 'merged' else 'error'] = message
+            manifest['pairs'].append(entry)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    manifest['pairs'].sort(key=lambda entry: entry['individual'])
+    return manifest
+
+
 if __name__ == '__main__':
 
     import argparse
 
     argparser = argparse.ArgumentParser()
-    argparser.add_argument('inputs', nargs='+', help='paths of input(s)')
+    argparser.add_argument('inputs', nargs='*', help='paths of input(s)')
     argparser.add_argument('-o', '--outbase', help='base for output names')
     argparser.add_argument('-v', '--voxel_order', help='reorder the voxels, default LPS', default='LPS')
     argparser.add_argument('-d', '--debug', help='enable debug logging', action='store_true', default=False)
+    argparser.add_argument('-j', '--jobs', type=int, help='number of inputs (or pairs, with --batch) reconstructed in parallel [default=number of inputs, at most the number of CPUs; 1 pair with --batch]')
+    argparser.add_argument('--percentiles', choices=['exact', 'sample', 'histogram'], help='how the cal_min/cal_max percentiles are computed: exactly, from a strided sample, or from a streaming histogram [default=exact; histogram with --low-memory]')
+    argparser.add_argument('--low-memory', action='store_true', help='concatenate volume by volume into a memory-mapped output, instead of in memory')
+    argparser.add_argument('--keep-intermediates', action='store_true', help='write the reconstructed nifti of each input next to the output, and merge from those files')
+    argparser.add_argument('--in-memory', action='store_true', help='build the reconstructed nifti of each input from the parsed dicoms instead of writing them with scidata; faster, but the images lack header fields such as descrip and slice timing')
+    argparser.add_argument('--batch', metavar='TAR_PATH', help='merge every individual and combined coil series pair among the archives of a dicomsort.py tar output path')
+    argparser.add_argument('--manifest', metavar='PATH', default='multicoil_manifest.json', help='with --batch, write the pairs and their outputs to PATH as json [default=multicoil_manifest.json]')
     args = argparser.parse_args()
 
     if args.debug:
         log.setLevel(logging.DEBUG)
 
+    if args.batch:
+        if args.inputs or args.outbase:
+            argparser.error('--batch takes no inputs or outbase')
+        manifest = batch_concat(args.batch, args)
+        with open(args.manifest, 'w') as json_file:
+            json.dump(manifest, json_file, indent=2)
+            json_file.write('\n')
+        sys.exit(1 if manifest['errors'] or any(entry['status'] == 'failed' for entry in manifest['pairs']) else 0)
+    if not args.inputs:
+        argparser.error('inputs are required without --batch')
+
     outbase = None
     if args.outbase:
         outbase = args.outbase
@@ -158,5 +406,6 @@ if __name__ == '__main__':
     for i in args.inputs:
         inputs.append(os.path.abspath(i))
 
-    n = NiftiConcat(inputs, outbase, args.voxel_order)
+    n = NiftiConcat(inputs, outbase, args.voxel_order, args.low_memory, args.percentiles, args.jobs,
+                    args.keep_intermediates, args.in_memory)
     n.process()
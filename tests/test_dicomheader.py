@@ -0,0 +1,46 @@
+import io
+import pytest
+
+pytest.importorskip('dicom')
+from dicom.errors import InvalidDicomError
+
+import dicomheader
+from test_dicomsort import write_dicom
+
+
+@pytest.fixture(scope="function")
+def dicom_path(tmpdir):
+    path = str(tmpdir.join('1.dcm'))
+    write_dicom(path, 4, 1)
+    return path
+
+
+def test_read_header_stops_after_keywords(dicom_path):
+    dcm = dicomheader.read_header(dicom_path, ['StudyInstanceUID', 'Manufacturer'])
+    assert dcm.StudyInstanceUID == '1.2.3'
+    assert dcm.Manufacturer == 'SIEMENS'
+    assert 'SeriesNumber' not in dcm        # (0020,0011) comes after StudyInstanceUID (0020,000D)
+    assert 'InstanceNumber' not in dcm
+
+
+def test_read_header_fileobj(dicom_path):
+    with open(dicom_path, 'rb') as fileobj:
+        dcm = dicomheader.read_header(io.BytesIO(fileobj.read()), ['SeriesNumber'])
+    assert dcm.SeriesNumber == 4
+
+
+def test_read_header_without_keywords(dicom_path):
+    dcm = dicomheader.read_header(dicom_path)
+    assert dcm.InstanceNumber == 1
+
+
+def test_read_header_rejects_non_dicom(tmpdir):
+    tmpdir.join('notes.txt').write('x' * 200)
+    with pytest.raises(InvalidDicomError):
+        dicomheader.read_header(str(tmpdir.join('notes.txt')), ['StudyInstanceUID'])
+
+
+def test_stop_tag():
+    assert dicomheader.stop_tag(['StudyInstanceUID', 'PatientID']) == 0x0020000d
+    assert dicomheader.stop_tag(['PatientID', 'NotAKeyword']) == dicomheader.PIXEL_DATA
+    assert dicomheader.stop_tag([]) == dicomheader.PIXEL_DATA
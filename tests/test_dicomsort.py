@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import argparse
+import tarfile
+import subprocess
+import pytest
+
+dicom = pytest.importorskip('dicom')
+from dicom.dataset import Dataset, FileDataset
+
+import dicomsort
+import progress
+
+DICOMSORT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dicomsort.py')
+
+
+def write_dicom(path, series_no, instance_no):
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    file_meta.MediaStorageSOPInstanceUID = '1.2.3.%d.%d' % (series_no, instance_no)
+    file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+    file_meta.ImplementationClassUID = '1.2.3.4'
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble='\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.StudyInstanceUID = '1.2.3'
+    ds.StudyID = '7'
+    ds.SeriesNumber = series_no
+    ds.InstanceNumber = instance_no
+    ds.Manufacturer = 'SIEMENS'
+    ds.save_as(path)
+
+
+@pytest.fixture(scope="function")
+def mess(tmpdir):
+    # files of three series, interleaved so that every file evicts another series' archive
+    for instance_no in range(1, 6):
+        for series_no in range(1, 4):
+            write_dicom(str(tmpdir.join('mess', '%d_%d.dcm' % (series_no, instance_no)).ensure()), series_no, instance_no)
+    return tmpdir
+
+
+@pytest.mark.parametrize('skip_sort_dir', [False, True])
+def test_tarsort_stream_reads_as_stream(mess, skip_sort_dir):
+    tar_path = str(mess.join('tar'))
+    stats_json = str(mess.join('stats.json'))
+    cmd = [sys.executable, DICOMSORT, 'tarsort', '--stream', '--max-open', '1', '-q', '--stats-json', stats_json,
+           str(mess.join('mess')), str(mess.join('sort')), tar_path]
+    subprocess.check_call(cmd + (['--skip-sort-dir'] if skip_sort_dir else []))
+    archives = sorted(os.listdir(tar_path))
+    assert [fn for fn in archives if fn.endswith('.tgz')] == ['1.2.3_7_%d_dicoms.tgz' % i for i in range(1, 4)]
+    assert not [fn for fn in archives if fn.endswith('.part')]
+    for series_no in range(1, 4):
+        with tarfile.open(os.path.join(tar_path, '1.2.3_7_%d_dicoms.tgz' % series_no), 'r|gz') as archive:
+            names = [member.name for member in archive]
+        expected = ['7_%d_dicoms/%d_%d.dcm' % (series_no, series_no, i) for i in range(1, 6)]
+        assert sorted(name for name in names if name.endswith('.dcm')) == expected
+        assert '7_%d_dicoms/metadata.json' % series_no in names
+    # streamed files are counted apart from the series archives that tar() compresses afterwards
+    stats = json.load(open(stats_json))
+    assert stats['stream']['count'] == 15
+    assert stats.get('compress', {'count': 0})['count'] == 0
+
+
+def test_tarsort_stream_rejects_other_compressors(mess):
+    cmd = [sys.executable, DICOMSORT, 'tarsort', '--stream', '--compressor', 'zstd',
+           str(mess.join('mess')), str(mess.join('sort')), str(mess.join('tar'))]
+    assert subprocess.call(cmd, stderr=open(os.devnull, 'w')) == 2
+    assert not mess.join('tar').check()
+
+
+@pytest.fixture(scope="function")
+def checksums(monkeypatch):
+    """The paths dicomsort.checksum is called with."""
+    calls = []
+    checksum = dicomsort.checksum
+    def counting_checksum(path):
+        calls.append(path)
+        return checksum(path)
+    monkeypatch.setattr(dicomsort, 'checksum', counting_checksum)
+    return calls
+
+
+def test_digest_index_size_mismatch(tmpdir, checksums):
+    tmpdir.join('a').write('data')
+    tmpdir.join('b').write('more data')
+    index = dicomsort.DigestIndex(str(tmpdir.join('index.sqlite')))
+    assert not index.identical(str(tmpdir.join('a')), str(tmpdir.join('b')))
+    index.close()
+    assert checksums == []
+
+
+def test_digest_index_served_from_index(tmpdir, checksums):
+    a, b = str(tmpdir.join('a')), str(tmpdir.join('b'))
+    tmpdir.join('a').write('data')
+    tmpdir.join('b').write('data')
+    index = dicomsort.DigestIndex(str(tmpdir.join('index.sqlite')))
+    assert index.identical(a, b)
+    index.close()
+    assert checksums == [a, b]
+    # a second run reads the digests from the index, until a file changes
+    index = dicomsort.DigestIndex(str(tmpdir.join('index.sqlite')))
+    assert index.identical(a, b)
+    assert checksums == [a, b]
+    tmpdir.join('b').write('dat2')
+    os.utime(b, (0, 0))
+    assert not index.identical(a, b)
+    index.close()
+    assert checksums == [a, b, b]
+
+
+def test_digest_index_forget(tmpdir, checksums):
+    a = str(tmpdir.join('a'))
+    tmpdir.join('a').write('data')
+    index = dicomsort.DigestIndex(str(tmpdir.join('index.sqlite')))
+    digest = index.digest(a)
+    index.forget(a)
+    assert index.digest(a) == digest
+    index.close()
+    assert checksums == [a, a]
+
+
+def test_journal(tmpdir):
+    path = str(tmpdir.join('journal'))
+    journal = dicomsort.Journal(path)
+    journal.record('skip', 'a')
+    journal.close()
+    with open(path, 'a') as journal_file:
+        journal_file.write('{"op": "skip", "ke')     # torn by an interrupted run
+    assert ('skip', 'a') not in dicomsort.Journal(path)
+    journal = dicomsort.Journal(path, resume=True)
+    assert ('skip', 'a') in journal
+    assert ('skip', 'b') not in journal
+    journal.close()
+
+
+def sort_args(mess, resume=False):
+    return argparse.Namespace(path=str(mess.join('mess')), sort_path=str(mess.join('sort')), verbose=False, jobs=1,
+                              resume=resume, quiet=True, progress=progress.Progress(quiet=True))
+
+
+def test_sort_resume_skips_journaled_files(mess, monkeypatch):
+    mess.join('mess', 'notes.txt').write('not a dicom')
+    mess.join('mess', 'other.txt').write('not a dicom either')
+    parsed = []
+    read_routing = dicomsort.read_routing
+    def recording_read_routing(filepath):
+        parsed.append(os.path.basename(filepath))
+        return read_routing(filepath)
+    monkeypatch.setattr(dicomsort, 'read_routing', recording_read_routing)
+
+    dicomsort.sort(sort_args(mess))
+    assert len(parsed) == 17
+    assert sorted(os.listdir(str(mess.join('mess')))) == ['notes.txt', 'other.txt']
+    # journal keys are absolute paths, so a run from another directory matches them
+    mess.join('mess', 'other.txt').write('changed')
+    del parsed[:]
+    monkeypatch.chdir(str(mess.join('mess')))
+    args = sort_args(mess, resume=True)
+    args.path = '.'
+    dicomsort.sort(args)
+    assert parsed == ['other.txt']
+    del parsed[:]
+    dicomsort.sort(sort_args(mess))
+    assert sorted(parsed) == ['notes.txt', 'other.txt']
+    # runs without --resume append to the journal as well
+    with open(str(mess.join('sort', dicomsort.SORT_JOURNAL))) as journal_file:
+        assert len(journal_file.readlines()) == 5
+
+
+def test_sort_jobs(mess):
+    mess.join('mess', 'notes.txt').write('not a dicom')
+    serial = mess.mkdir('serial')
+    mess.join('mess').copy(serial.join('mess'))
+    dicomsort.sort(sort_args(serial))
+    args = sort_args(mess)
+    args.jobs = 2
+    dicomsort.sort(args)
+    tree = lambda path: sorted(os.path.relpath(os.path.join(dirpath, fn), path)
+                               for dirpath, _, filenames in os.walk(path) for fn in filenames if not fn.startswith('.'))
+    assert tree(str(mess.join('sort'))) == tree(str(serial.join('sort')))
+    assert os.listdir(str(mess.join('mess'))) == ['notes.txt']
+
+
+def test_series_archive_reopened(tmpdir):
+    for name in ['a', 'b']:
+        tmpdir.join(name).write(name * 1000)
+    path = str(tmpdir.join('series.tgz'))
+    archive = dicomsort.SeriesArchive(path, 'series', {'filetype': 'dicom'})
+    assert archive.add(str(tmpdir.join('a')))
+    archive.close()
+    archive.reopen()
+    assert archive.add(str(tmpdir.join('b')))
+    assert archive.add(str(tmpdir.join('a')))
+    tmpdir.join('a').write('c' * 1000)
+    assert not archive.add(str(tmpdir.join('a')))
+    archive.close()
+    archive.finish()
+    assert not tmpdir.join('series.tgz.part').check()
+    # a single gzip member, which streaming readers read to the end
+    with tarfile.open(path, 'r|gz') as tar:
+        contents = [(member.name, tar.extractfile(member).read() if member.isfile() else None) for member in tar]
+    assert contents == [('series', None), ('series/metadata.json', '{"filetype": "dicom"}'),
+                        ('series/a', 'a' * 1000), ('series/b', 'b' * 1000)]
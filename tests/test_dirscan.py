@@ -0,0 +1,44 @@
+import os
+import pytest
+
+import dirscan
+
+
+@pytest.fixture(scope="function")
+def tree(tmpdir):
+    for path in ['a/x/1.dcm', 'a/x/2.dcm', 'a/y/3.dcm', 'b/4.dcm', '5.txt', 'c/.hidden']:
+        tmpdir.join(path).write('data', ensure=True)
+    tmpdir.join('link.txt').mksymlinkto(tmpdir.join('5.txt'))
+    tmpdir.join('b/link_dir').mksymlinkto(tmpdir.join('a'))
+    return str(tmpdir)
+
+
+def walk_files(root):
+    return [os.path.join(dirpath, fn) for dirpath, _, filenames in os.walk(root) for fn in filenames]
+
+
+def walk_dirs(root):
+    return [os.path.join(dirpath, dn) for dirpath, dirnames, _ in os.walk(root) for dn in dirnames]
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_scan_matches_os_walk(tree, jobs):
+    assert [e.path for e in dirscan.scan(tree, jobs=jobs)] == walk_files(tree)
+    assert [e.path for e in dirscan.scan(tree, files=False, dirs=True, jobs=jobs)] == walk_dirs(tree)
+
+
+def test_scan_entries(tree):
+    entries = dict((os.path.relpath(e.path, tree), e) for e in dirscan.scan(tree, dirs=True))
+    assert entries['a/x/1.dcm'].size == 4
+    assert entries['a/x/1.dcm'].mtime == os.path.getmtime(os.path.join(tree, 'a/x/1.dcm'))
+    assert entries['link.txt'].is_link and not entries['link.txt'].is_dir
+    assert entries['b/link_dir'].is_link and entries['b/link_dir'].is_dir
+    assert 'b/link_dir/x' not in entries
+    assert all(e.size is None for e in dirscan.scan(tree, stat=False))
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_leaf_dirs_matches_os_walk(tree, jobs):
+    expected = [dirpath for dirpath, dirnames, _ in os.walk(tree) if not dirnames]
+    assert dirscan.leaf_dirs(tree, jobs=jobs) == expected
+    assert dirscan.leaf_dirs(os.path.join(tree, 'c')) == [os.path.join(tree, 'c')]
@@ -0,0 +1,25 @@
+import pytest
+
+import montage
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def test_build_montages(tmpdir):
+    paths = []
+    for i, size in enumerate([(10, 6), (4, 8), (10, 8)]):
+        path = str(tmpdir.join('%d.png' % i))
+        Image.new('RGB', size, (0, 0, 255)).save(path)
+        paths.append(path)
+    out_path = str(tmpdir.join('montage.png'))
+    montage.build_montages([(paths, out_path), ([], str(tmpdir.join('empty.png')))], threads=2)
+
+    result = Image.open(out_path)
+    # 2 columns and 2 rows of 18x16 tiles
+    assert result.size == (36, 32)
+    assert result.getpixel((0, 0)) == (255, 255, 255)
+    assert result.getpixel((9, 8)) == (0, 0, 255)
+    assert result.getpixel((18 + 4, 8)) == (255, 255, 255)     # 4 wide image centered in 18
+    assert result.getpixel((18 + 9, 8)) == (0, 0, 255)
+    assert result.getpixel((27, 24)) == (255, 255, 255)        # no fourth image
+    assert not tmpdir.join('empty.png').check()
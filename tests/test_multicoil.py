@@ -0,0 +1,90 @@
+import tarfile
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('dicom')     # of dicomheader
+import multicoil
+
+
+def volumes():
+    rng = np.random.RandomState(0)
+    # later volumes fall below and above the range of the first, so the histogram range doubles both ways
+    return [rng.normal(100, 10, (16, 16, 8)), rng.normal(60, 30, (16, 16, 8)), rng.gamma(2., 200., (16, 16, 8))]
+
+
+def test_clip_values():
+    data = np.arange(1001, dtype=np.float64)
+    assert list(multicoil.clip_values(data)) == [100., 995.]
+    assert list(multicoil.clip_values(data * 1j)) == [100., 995.]
+
+
+@pytest.mark.parametrize('mode', ['sample', 'histogram'])
+def test_percentile_estimator_within_error(mode):
+    estimator = multicoil.PercentileEstimator(mode)
+    for volume in volumes():
+        estimator.add(volume)
+    values = estimator.result()
+    exact = np.percentile(np.concatenate([volume.ravel() for volume in volumes()]), multicoil.CLIP_PERCENTILES)
+    assert estimator.error > 0
+    assert np.all(np.abs(values - exact) <= estimator.error)
+
+
+def test_histogram_range_doubles():
+    estimator = multicoil.PercentileEstimator('histogram')
+    first, low, high = volumes()[0], -1000., 5000.
+    estimator.add(first)
+    width = estimator.width
+    estimator.add(np.array([low, high]))
+    assert estimator.low <= low and estimator.low + estimator.width * multicoil.HISTOGRAM_BINS >= high
+    assert estimator.width / width == 2 ** int(round(np.log2(estimator.width / width)))
+    assert estimator.counts.sum() == first.size + 2
+
+
+def test_histogram_constant_and_complex():
+    estimator = multicoil.PercentileEstimator('histogram')
+    estimator.add(np.full((4, 4), 7.))
+    assert np.allclose(estimator.result(), [7., 7.], atol=estimator.error)
+    estimator = multicoil.PercentileEstimator('histogram')
+    estimator.add(np.arange(1001) * 1j)
+    assert np.allclose(estimator.result(), [100., 995.], atol=estimator.error)
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        multicoil.PercentileEstimator('exact')
+
+
+def series(name, series_no, description, images, study_uid='1.2.3'):
+    return multicoil.Series(name, study_uid, series_no, description, images)
+
+
+def test_pair_series():
+    pairs, unpaired = multicoil.pair_series([
+        series('combined_4', 4, 'ep2d', 10), series('individual_3', 3, 'ep2d', 320),
+        series('t1_5', 5, 't1', 176),
+        series('combined_9', 9, 'fl', 40), series('individual_10', 10, 'fl', 1280),
+        series('same_11', 11, 'dwi', 60), series('same_12', 12, 'dwi', 60),
+        series('other_study', 6, 't1', 176, study_uid='1.2.4'),
+    ])
+    assert [(individual.path, combined.path) for individual, combined in pairs] == [
+        ('individual_3', 'combined_4'), ('individual_10', 'combined_9')]
+    assert [info.path for info in unpaired] == ['t1_5', 'same_11', 'same_12', 'other_study']
+
+
+def test_series_info(tmpdir):
+    from test_dicomsort import write_dicom
+    archive_path = str(tmpdir.join('1.2.3_7_2_dicoms.tgz'))
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        tmpdir.join('metadata.json').write('{}')
+        archive.add(str(tmpdir.join('metadata.json')), '7_2_dicoms/metadata.json')
+        for instance_no in range(3):
+            path = str(tmpdir.join('%d.dcm' % instance_no))
+            write_dicom(path, 2, instance_no)
+            archive.add(path, '7_2_dicoms/%d.dcm' % instance_no)
+    assert multicoil.series_info(archive_path) == multicoil.Series(archive_path, '1.2.3', 2, '', 3)
+
+    with open(archive_path, 'rb') as archive_file:
+        truncated = archive_file.read()[:-40]
+    tmpdir.join('truncated.tgz').write(truncated, mode='wb')
+    with pytest.raises((IOError, EOFError, tarfile.ReadError)):
+        multicoil.series_info(str(tmpdir.join('truncated.tgz')))
@@ -0,0 +1,144 @@
+import io
+import os
+import sys
+import json
+import tarfile
+import zipfile
+import pytest
+
+dicom = pytest.importorskip('dicom')     # of dicomheader
+import archive_to_folder_reaper as reaper
+from test_dicomsort import write_dicom
+
+
+def add_file(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 1500000000
+    info.mode = 0644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def tgz_data(files):
+    """Return a gzipped tar of files, a list of (name, data), as a string."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, data in files:
+            add_file(tar, name, data)
+    return buf.getvalue()
+
+
+@pytest.fixture(scope="function")
+def nims_tar(tmpdir):
+    """A NIMS tar of two sessions, with member names starting with './' and no directory members."""
+    dicoms = []
+    for instance_no in range(1, 3):
+        path = str(tmpdir.join('%d.dcm' % instance_no))
+        write_dicom(path, 1, instance_no)
+        ds = dicom.read_file(path)
+        ds.PatientID = 'subj1@grp'
+        ds.save_as(path)
+        dicoms.append(('1_1_1_dicoms/%d.dcm' % instance_no, open(path, 'rb').read()))
+    session = './nims/grp/prj/ex100_s1/'
+    members = [
+        (session + '1_1_T1/1_1_1_dicoms.tgz', tgz_data(dicoms + [('1_1_1_dicoms/DIGEST.txt', 'x')])),
+        (session + '1_1_T1/1_1_1_physio.tgz', tgz_data([('1_1_1_physio/PPGData_1', 'ppg' * 100),
+                                                        ('1_1_1_physio/RESPData_1', 'resp' * 100)])),
+        (session + '2_1_fMRI/2_1_1_pfile.tgz', tgz_data([('2_1_1_pfile/P12345.7', 'p' * 5000),
+                                                         ('2_1_1_pfile/P12345_refscan.7', 'r' * 100),
+                                                         ('2_1_1_pfile/METADATA.json', '{}')])),
+        (session + '2_1_fMRI/notes.txt', 'notes'),
+        ('./nims/grp/prj2/ex200_s2/3_1_x/file.txt', 'data'),
+    ]
+    path = str(tmpdir.join('nims.tar'))
+    with tarfile.open(path, 'w') as tar:
+        for name, data in members:
+            add_file(tar, name, data)
+    return path
+
+
+def run_reaper(monkeypatch, capsys, args):
+    """Run the reaper's main with args and return what it printed."""
+    monkeypatch.setattr(sys, 'argv', ['archive_to_folder_reaper.py'] + args + ['-l', 'warning'])
+    reaper.main()
+    return capsys.readouterr()[0]
+
+
+def normalized(groups, root):
+    """groups of build_tree_index as nested dicts of relative paths, with sorted file and dir lists."""
+    rel = lambda path: os.path.relpath(path, root)
+    return {rel(group): {rel(project): {rel(session): (sorted(map(rel, files)), sorted(map(rel, dirs)))
+                                        for session, (files, dirs) in sessions.items()}
+                         for project, sessions in projects.items()}
+            for group, projects in groups.items()}
+
+
+def test_build_tree_index(tmpdir):
+    for path in ['nims/grp/prj/ses1/acq1/a.dcm', 'nims/grp/prj/ses1/acq1/b.dcm', 'nims/grp/prj/ses1/notes.txt',
+                 'nims/grp/prj/ses2/acq2/deep/c.dcm', 'nims/grp/prj2/ses3/x.7', 'nims/other/prj/ses4/y.txt',
+                 'nims/grp/stray.txt', 'nims/grp/prj/stray.txt']:
+        tmpdir.join(path).write('data', ensure=True)
+    tmpdir.join('nims/grp/empty_prj').ensure(dir=True)
+    root = str(tmpdir)
+
+    db_root, groups = reaper.build_tree_index(root)
+    assert db_root == os.path.join(root, 'nims')
+    assert normalized(groups, root) == {
+        'nims/grp': {
+            'nims/grp/prj': {
+                'nims/grp/prj/ses1': (['nims/grp/prj/ses1/acq1/a.dcm', 'nims/grp/prj/ses1/acq1/b.dcm',
+                                       'nims/grp/prj/ses1/notes.txt'], ['nims/grp/prj/ses1/acq1']),
+                'nims/grp/prj/ses2': (['nims/grp/prj/ses2/acq2/deep/c.dcm'],
+                                      ['nims/grp/prj/ses2/acq2', 'nims/grp/prj/ses2/acq2/deep']),
+            },
+            'nims/grp/prj2': {'nims/grp/prj2/ses3': (['nims/grp/prj2/ses3/x.7'], [])},
+            'nims/grp/empty_prj': {},
+        },
+        'nims/other': {'nims/other/prj': {'nims/other/prj/ses4': (['nims/other/prj/ses4/y.txt'], [])}},
+    }
+
+
+def test_build_tree_index_shallow(tmpdir):
+    tmpdir.join('nims/grp/prj/file.txt').write('data', ensure=True)
+    assert reaper.build_tree_index(str(tmpdir)) == (os.path.join(str(tmpdir), 'nims'), {})
+    assert reaper.build_tree_index(str(tmpdir.join('nims/grp/prj'))) == (None, {})
+
+
+def test_plan_targets(tmpdir, nims_tar, monkeypatch, capsys):
+    output = tmpdir.mkdir('out')
+    plan = json.loads(run_reaper(monkeypatch, capsys, [nims_tar, str(output), '--plan']))
+    assert plan['db_root'] == 'nims'
+    assert [session['target'] for session in plan['sessions']] == ['grp/prj/subj1/ex100_s1', 'grp/prj2/sub_ex200_s2/ex200_s2']
+    assert [session['subject_from'] for session in plan['sessions']] == ['dicom', 'session label']
+
+    output_path = run_reaper(monkeypatch, capsys, [nims_tar, str(output)]).strip()
+    targets = [os.path.relpath(dirpath, output_path) for dirpath, _, _ in os.walk(output_path)]
+    assert sorted(target for target in targets if target.count(os.sep) == 3) == \
+        sorted(session['target'] for session in plan['sessions'])
+
+
+def tree(path):
+    """The relative paths of the files and folders below path, with the contents of each file or zip member."""
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames:
+            entries[os.path.relpath(os.path.join(dirpath, name), path)] = None
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+            if name.endswith('.zip'):
+                with zipfile.ZipFile(file_path) as zf:
+                    contents = sorted((info.filename, zf.read(info)) for info in zf.infolist())
+            else:
+                contents = open(file_path, 'rb').read()
+            entries[os.path.relpath(file_path, path)] = contents
+    return entries
+
+
+def test_stream_untar(tmpdir, nims_tar, monkeypatch, capsys):
+    output_path = run_reaper(monkeypatch, capsys, [nims_tar, str(tmpdir.mkdir('out'))]).strip()
+    stream_output_path = run_reaper(monkeypatch, capsys, [nims_tar, str(tmpdir.mkdir('stream')), '--stream']).strip()
+    converted = tree(output_path)
+    assert 'grp/prj/subj1/ex100_s1/1_1_T1/dicom/1.dcm' in converted
+    assert 'grp/prj/subj1/ex100_s1/1_1_T1/1_1_1_physio.gephysio.zip' in converted
+    assert 'grp/prj/subj1/ex100_s1/2_1_fMRI/2_1_1_pfile.7.zip' in converted
+    assert tree(stream_output_path) == converted
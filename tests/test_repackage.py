@@ -0,0 +1,102 @@
+import io
+import gzip
+import json
+import tarfile
+import argparse
+import pytest
+
+import repackage
+
+
+def make_dicom_tgz(path):
+    with tarfile.open(path, 'w:gz') as archive:
+        info = tarfile.TarInfo('1_2_dicoms')
+        info.type = tarfile.DIRTYPE
+        archive.addfile(info)
+        for name, data in [('1_2_dicoms/b.dcm', 'bbb'), ('1_2_dicoms/a.dcm', 'aaaa'), ('1_2_dicoms/notes.txt', 'n'),
+                           ('1_2_dicoms/METADATA.json', '{"filetype": "dicom", "acquisition": {"label": "T1"}}\n'),
+                           ('1_2_dicoms/DIGEST.txt', 'stale\n')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+
+def read_archive(path):
+    with tarfile.open(path) as archive:
+        return [(m.name, archive.extractfile(m).read() if m.isfile() else None) for m in archive]
+
+
+@pytest.mark.parametrize('group', [None, 'grp'])
+def test_stream_repackage_matches_repackage(tmpdir, group):
+    tgz = str(tmpdir.join('1_2_dicoms.tgz'))
+    make_dicom_tgz(tgz)
+    results = {}
+    for stream in [False, True]:
+        outdir = str(tmpdir.join('stream' if stream else 'extract'))
+        args = argparse.Namespace(group=group, project=None, stream=stream)
+        repackage.repackage(tgz, outdir, args)
+        results[stream] = read_archive(outdir + '/1_2_dicoms.tgz')
+
+    assert sorted(results[True]) == sorted(results[False])
+    members = dict(results[True])
+    assert [name for name, _ in results[True]][:3] == ['1_2_dicoms', '1_2_dicoms/METADATA.json', '1_2_dicoms/DIGEST.txt']
+    assert members['1_2_dicoms/DIGEST.txt'] == 'METADATA.json\nDIGEST.txt\nnotes.txt\na.dcm\nb.dcm\n'
+    metadata = json.loads(members['1_2_dicoms/METADATA.json'])
+    assert metadata['acquisition'] == {'label': 'T1'}
+    if group:
+        assert metadata['overwrite'] == {'group_name': 'grp', 'project_name': 'unknown'}
+    else:
+        assert 'overwrite' not in metadata
+
+
+def test_stream_repackage_in_place(tmpdir):
+    tgz = str(tmpdir.join('1_2_dicoms.tgz'))
+    make_dicom_tgz(tgz)
+    repackage.stream_repackage(tgz, tgz, argparse.Namespace(group='grp', project='prj'))
+    members = dict(read_archive(tgz))
+    assert members['1_2_dicoms/a.dcm'] == 'aaaa'
+    assert json.loads(members['1_2_dicoms/METADATA.json'])['overwrite']['project_name'] == 'prj'
+    assert not tmpdir.join('1_2_dicoms.tgz.part').check()
+
+
+def test_stream_repackage_multi_member_gzip(tmpdir):
+    # a generic multi-member gzip, e.g. gzipped parts concatenated with cat: one gzip member per part
+    tgz = str(tmpdir.join('1_2_dicoms.tgz'))
+    make_dicom_tgz(tgz)
+    tar = gzip.open(tgz).read()
+    with open(tgz, 'wb') as tgz_file:
+        for start, end in [(0, 2048), (2048, 4096), (4096, len(tar))]:
+            member = io.BytesIO()
+            with gzip.GzipFile(fileobj=member, mode='wb') as gzip_file:
+                gzip_file.write(tar[start:end])
+            tgz_file.write(member.getvalue())
+    expected = dict(read_archive(tgz))
+
+    assert repackage.peek_metadata(tgz)['acquisition'] == {'label': 'T1'}
+    repackage.stream_repackage(tgz, tgz, argparse.Namespace(group='grp', project='prj'))
+    members = dict(read_archive(tgz))
+    assert members['1_2_dicoms/DIGEST.txt'] == 'METADATA.json\nDIGEST.txt\nnotes.txt\na.dcm\nb.dcm\n'
+    for name in ['1_2_dicoms/a.dcm', '1_2_dicoms/b.dcm', '1_2_dicoms/notes.txt']:
+        assert members[name] == expected[name]
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_batch_repackage(tmpdir, stream):
+    paths = []
+    for name in ['1_2_dicoms', '1_3_dicoms']:
+        paths.append(str(tmpdir.join(name + '.tgz')))
+        make_dicom_tgz(paths[-1])
+    tmpdir.join('broken.tgz').write('not a tar file')
+    paths.append(str(tmpdir.join('broken.tgz')))
+    outdir = str(tmpdir.join('out'))
+    args = argparse.Namespace(group='grp', project='prj', stream=stream, jobs=2)
+
+    results = repackage.batch_repackage(paths, outdir, args)
+    assert sorted(status for _, status, _ in results) == ['failed', 'repackaged', 'repackaged']
+    assert repackage.peek_metadata(outdir + '/1_2_dicoms.tgz')['overwrite'] == {'group_name': 'grp', 'project_name': 'prj'}
+
+    results = repackage.batch_repackage(paths[:2], outdir, args)
+    assert [status for _, status, _ in results] == ['skipped', 'skipped']
+    args.project = 'other'
+    results = repackage.batch_repackage(paths[:1], outdir, args)
+    assert [status for _, status, _ in results] == ['repackaged']
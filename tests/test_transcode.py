@@ -0,0 +1,57 @@
+import io
+import gzip
+import tarfile
+import zipfile
+import subprocess
+import pytest
+
+import transcode
+
+
+def make_tgz(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1400000000
+            info.mode = 0640
+            tar.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    return buf
+
+
+def test_tar_to_zip(tmpdir):
+    files = [('top/a.txt', 'hello ' * 1000), ('top/P1.7', ''.join(chr(i % 251) for i in range(300000)))]
+    zip_path = str(tmpdir.join('out.zip'))
+    with tarfile.open(fileobj=make_tgz(files), mode='r|gz') as tar:
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for member in tar:
+                chunks = transcode.read_chunks(tar.extractfile(member), size=4096)
+                if member.name.endswith('.7'):
+                    zinfo = transcode.member_zipinfo(member, member.name + '.gz', zipfile.ZIP_STORED)
+                    chunks = transcode.gzip_chunks(chunks)
+                else:
+                    zinfo = transcode.member_zipinfo(member, member.name)
+                transcode.write_chunks(zf, zinfo, chunks, member.size)
+            zf.writestr('top/after.txt', 'appended')
+
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['top/a.txt', 'top/P1.7.gz', 'top/after.txt']
+        assert zf.read('top/a.txt') == files[0][1]
+        assert gzip.GzipFile(fileobj=io.BytesIO(zf.read('top/P1.7.gz'))).read() == files[1][1]
+        info = zf.getinfo('top/a.txt')
+        assert info.external_attr >> 16 == 0100640
+        assert info.compress_size < info.file_size
+
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_parallel_gzip_chunks(tmpdir, threads):
+    data = ''.join(chr(i % 253) for i in range(100000))
+    gz_path = tmpdir.join('data.gz')
+    for content in [data, '']:
+        chunks = transcode.read_chunks(io.BytesIO(content), size=7000)
+        gz_path.write(''.join(transcode.parallel_gzip_chunks(chunks, level=6, threads=threads)), mode='wb')
+        assert gzip.open(str(gz_path)).read() == content
+        assert subprocess.check_output(['gzip', '-dc', str(gz_path)]) == content
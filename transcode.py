@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Streaming tar to zip transcoding.
+
+Tar members are read as streams and written straight into a zip file, gzipped
+on the way if needed, so nothing is extracted to disk first. Python 2's ZipFile
+can only add files from disk or from a string, so write_chunks adds a member
+from an iterable of chunks the way ZipFile.write does for a file.
+
+example usage:
+    with tarfile.open('/path/to/archive.tgz', 'r|gz') as tar:
+        with zipfile.ZipFile('/path/to/archive.zip', 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for member in tar:
+                if member.isfile():
+                    chunks = gzip_chunks(read_chunks(tar.extractfile(member)))
+                    write_chunks(zf, member_zipinfo(member, member.name + '.gz'), chunks, member.size)
+
+"""
+
+import stat
+import time
+import zlib
+import zipfile
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+CHUNK_SIZE = 1024 * 1024
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024   # compressed separately by parallel_gzip_chunks
+
+
+def read_chunks(fileobj, size=CHUNK_SIZE):
+    """Yield the contents of fileobj in chunks of size bytes."""
+    while True:
+        chunk = fileobj.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def gzip_chunks(chunks, level=9):
+    """Yield chunks compressed into a single gzip stream, like gzip.open(..., 'wb') writes at the default level."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def gzip_block(block, level=9):
+    """Return block compressed as a complete gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def parallel_gzip_chunks(chunks, level=9, threads=None):
+    """
+    Yield chunks compressed by a pool of threads, each chunk as its own gzip member.
+
+    Concatenated gzip members are a valid gzip file (RFC 1952), which gzip,
+    zcat and Python's gzip module read as one stream. zlib releases the GIL
+    while compressing, so threads use all cores. At most two chunks per thread
+    are held in memory; read chunks of GZIP_BLOCK_SIZE to keep the members large.
+    threads defaults to the number of CPUs; with one thread, this is gzip_chunks.
+    """
+    threads = threads or multiprocessing.cpu_count()
+    if threads < 2:
+        for chunk in gzip_chunks(chunks, level):
+            yield chunk
+        return
+    pool = ThreadPool(threads)
+    pending = collections.deque()
+    try:
+        empty = True
+        for chunk in chunks:
+            empty = False
+            pending.append(pool.apply_async(gzip_block, (chunk, level)))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        if empty:
+            yield gzip_block('', level)
+    finally:
+        pool.terminate()
+
+
+def member_zipinfo(member, arcname, compress_type=zipfile.ZIP_DEFLATED):
+    """Return a ZipInfo for tar member under arcname, with its time and permissions."""
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(member.mtime)[:6])
+    if member.isdir():
+        zinfo.external_attr = ((stat.S_IFDIR | member.mode) << 16) | 0x10    # MS-DOS directory flag
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo.external_attr = (stat.S_IFREG | member.mode) << 16
+        zinfo.compress_type = compress_type
+    return zinfo
+
+
+def write_chunks(zf, zinfo, chunks, size_hint=0):
+    """
+    Add a member with the contents of chunks to the zip file zf, which must be open for writing.
+
+    Mirrors ZipFile.write: the local header is written first and rewritten with
+    the CRC and sizes at the end, so zf must be seekable. size_hint is the
+    expected size of the contents; it decides whether the header gets zip64
+    fields, so it must not be much smaller than the actual size.
+    """
+    if not zf.fp:
+        raise RuntimeError('Attempt to write to ZIP archive that was already closed')
+    if zinfo.filename.endswith('/'):
+        zf.writestr(zinfo, '')
+        return
+    zinfo.flag_bits = 0x00
+    zinfo.file_size = size_hint
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+
+    zinfo.CRC = crc = 0
+    zinfo.compress_size = compress_size = 0
+    # compressed size can be larger than uncompressed size
+    zip64 = zf._allowZip64 and size_hint * 1.05 > zipfile.ZIP64_LIMIT
+    zf.fp.write(zinfo.FileHeader(zip64))
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    else:
+        compressor = None
+    file_size = 0
+    for chunk in chunks:
+        file_size += len(chunk)
+        crc = zlib.crc32(chunk, crc) & 0xffffffff
+        if compressor:
+            chunk = compressor.compress(chunk)
+        compress_size += len(chunk)
+        zf.fp.write(chunk)
+    if compressor:
+        chunk = compressor.flush()
+        compress_size += len(chunk)
+        zf.fp.write(chunk)
+    zinfo.compress_size = compress_size
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    if not zip64 and zf._allowZip64 and max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+        raise RuntimeError('Member is larger than its size hint of %d bytes' % size_hint)
+
+    # seek back and rewrite the local header with the CRC and sizes
+    position = zf.fp.tell()
+    zf.fp.seek(zinfo.header_offset, 0)
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.seek(position, 0)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo